@@ -2,7 +2,9 @@
 simplepreprocessor expands limited set of C preprocessor macros
 """
 
-from .core import preprocess
+from .core import preprocess, preprocess_to_file, preprocess_to_string
 from .version import __version__
 
-__all__ = ["preprocess", "__version__"]
+__all__ = [
+    "preprocess", "preprocess_to_file", "preprocess_to_string", "__version__"
+]
@@ -1,5 +1,10 @@
-from simplecpreprocessor import preprocess
+from simplecpreprocessor import preprocess_to_file
+from simplecpreprocessor.guards import GuardDatabase
+from simplecpreprocessor.sourcemap import SourceMap
 import argparse
+import os.path
+
+OUTPUT_BUFFER = 1024 * 1024
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input-file", required=True,
@@ -8,19 +13,49 @@ parser.add_argument("--include-path", action="append",
                     help="Include paths", dest="include_paths",
                     default=[])
 parser.add_argument("--ignore-header", action="append",
-                    help="Headers to ignore. Useful for eg CFFI",
+                    help="Headers to ignore. Useful for eg CFFI. Accepts "
+                    "names, globs such as windows*.h or sys/** and "
+                    "re:REGEX patterns",
                     dest="ignore_headers", default=[])
 parser.add_argument("--output-file", required=True,
                     help="Output file that contains preprocessed header(s)")
+parser.add_argument("--guard-database",
+                    help="File that remembers include guards between runs")
+parser.add_argument("--prefetch", action="store_true",
+                    help="Read and tokenize includes in background threads")
+parser.add_argument("--compact", action="store_true",
+                    help="Coalesce whitespace and squeeze blank lines")
+parser.add_argument("--binary", action="store_true",
+                    help="Process files as bytes, passing through any "
+                    "encoding unchanged")
+parser.add_argument("--source-map", action="store_true",
+                    help="Write the origin of every output line to "
+                    "OUTPUT_FILE.map")
 
 
 def main(args=None):
     args = parser.parse_args(args)
-    with open(args.input_file) as i:
-        with open(args.output_file, "w") as o:
-            for line in preprocess(i, include_paths=args.include_paths,
-                                   ignore_headers=args.ignore_headers):
-                o.write(line)
+    guard_database = None
+    if args.guard_database is not None:
+        if os.path.exists(args.guard_database):
+            guard_database = GuardDatabase.load(args.guard_database)
+        else:
+            guard_database = GuardDatabase()
+    source_map = SourceMap() if args.source_map else None
+    mode = "b" if args.binary else ""
+    with open(args.input_file, "r" + mode) as i:
+        with open(args.output_file, "w" + mode,
+                  buffering=OUTPUT_BUFFER) as o:
+            preprocess_to_file(i, o, include_paths=args.include_paths,
+                               ignore_headers=args.ignore_headers,
+                               guard_database=guard_database,
+                               prefetch=args.prefetch, line_output=True,
+                               source_map=source_map, compact=args.compact,
+                               binary=args.binary)
+    if source_map is not None:
+        source_map.save(args.output_file + ".map")
+    if guard_database is not None:
+        guard_database.save(args.guard_database)
 
 
 main()
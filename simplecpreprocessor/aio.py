@@ -0,0 +1,168 @@
+"""
+Preprocessing inside an asyncio event loop.
+
+Async header handlers open, read and tokenize headers in coroutines and
+hand them over as filesystem.PrefetchedFile objects, so the preprocessor
+itself never waits for I/O. Output is an async iterator that returns
+control to the event loop every yield_interval output chunks.
+"""
+import asyncio
+
+from . import filesystem, platform
+from .core import (
+    DEFAULT_MAX_INCLUDE_DEPTH, Preprocessor, TOKEN_CONSTANTS,
+    constants_to_token_constants,
+)
+
+DEFAULT_YIELD_INTERVAL = 1024
+
+
+class ThreadedHeaderHandler(object):
+    """
+    Async header handler running a synchronous header handler in a thread
+    pool. Async handlers provide coroutines open_header(include_header,
+    skip_file, anchor_file, line_ending, verbatim) and load(f_object,
+    line_ending, verbatim) returning read and tokenized files, and
+    non-blocking file_identity(), read_chunks() and add_include_paths().
+    """
+
+    def __init__(self, handler=None, executor=None):
+        if handler is None:
+            handler = filesystem.HeaderHandler(())
+        self.handler = handler
+        # None uses the default executor of the event loop
+        self.executor = executor
+
+    def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, function, *args)
+
+    def _load(self, f_object, line_ending, verbatim):
+        f = self.handler.load(f_object, line_ending, verbatim)
+        # Identity needs a stat, so it is computed here and cached
+        self.handler.file_identity(f.name)
+        return f
+
+    def _open_header(self, include_header, skip_file, anchor_file,
+                     line_ending, verbatim):
+        f = self.handler.open_header(include_header, skip_file, anchor_file)
+        if f is None or f is filesystem.SKIP_FILE:
+            return f
+        with f:
+            return self._load(f, line_ending, verbatim)
+
+    async def open_header(self, include_header, skip_file, anchor_file,
+                          line_ending, verbatim=False):
+        return await self._run(self._open_header, include_header,
+                               skip_file, anchor_file, line_ending, verbatim)
+
+    async def load(self, f_object, line_ending, verbatim=False):
+        return await self._run(self._load, f_object, line_ending, verbatim)
+
+    def file_identity(self, name):
+        return self.handler.file_identity(name)
+
+    def read_chunks(self, f_object, line_ending, verbatim=False):
+        return self.handler.read_chunks(f_object, line_ending, verbatim)
+
+    def add_include_paths(self, include_paths):
+        self.handler.add_include_paths(include_paths)
+
+
+class IncludeRequest(object):
+    """Include to be opened by the async driver before continuing."""
+    __slots__ = ("header", "error", "anchor_file")
+
+    def __init__(self, header, error, anchor_file):
+        self.header = header
+        self.error = error
+        self.anchor_file = anchor_file
+
+
+class AsyncPreprocessor(Preprocessor):
+    """
+    Preprocessor whose includes are opened by an async header handler.
+
+    preprocess_async() is an async iterator of the output chunks.
+    """
+
+    def __init__(self, line_ending="\n", include_paths=(),
+                 header_handler=None, platform_constants=TOKEN_CONSTANTS,
+                 ignore_headers=(), fold_strings_to_null=False,
+                 int_bits=None, max_include_depth=DEFAULT_MAX_INCLUDE_DEPTH,
+                 line_output=False, token_output=False, source_map=None,
+                 compact=False, yield_interval=DEFAULT_YIELD_INTERVAL):
+        if header_handler is None:
+            header_handler = ThreadedHeaderHandler()
+        super().__init__(line_ending, include_paths, header_handler,
+                         platform_constants, ignore_headers,
+                         fold_strings_to_null, int_bits,
+                         max_include_depth=max_include_depth,
+                         line_output=line_output, token_output=token_output,
+                         source_map=source_map, compact=compact)
+        self.yield_interval = yield_interval
+
+    def _read_header(self, header, error, anchor_file=None):
+        # The driver loop hands the request to preprocess_async
+        if header not in self.ignore_headers:
+            return (IncludeRequest(header, error, anchor_file),)
+
+    async def preprocess_async(self, f_object):
+        headers = self.headers
+        f_object = await headers.load(f_object, self.line_ending,
+                                      self.verbatim)
+        chunks = self.preprocess(f_object)
+        count = 0
+        try:
+            for chunk in chunks:
+                if chunk.__class__ is IncludeRequest:
+                    f = await headers.open_header(
+                        chunk.header, self.skip_file, chunk.anchor_file,
+                        self.line_ending, self.verbatim
+                    )
+                    if f is None:
+                        raise chunk.error
+                    elif f is not filesystem.SKIP_FILE:
+                        self.push_file(f)
+                    continue
+                yield chunk
+                count += 1
+                if count == self.yield_interval:
+                    count = 0
+                    await asyncio.sleep(0)
+        finally:
+            chunks.close()
+
+
+def preprocess_async(f_object, line_ending="\n", include_paths=(),
+                     header_handler=None, extra_constants=(),
+                     ignore_headers=(), fold_strings_to_null=False,
+                     int_bits=None,
+                     max_include_depth=DEFAULT_MAX_INCLUDE_DEPTH,
+                     line_output=False, token_output=False, source_map=None,
+                     compact=False, yield_interval=DEFAULT_YIELD_INTERVAL):
+    """
+    Async iterator of the chunks preprocess() would yield for f_object.
+    header_handler follows the async protocol of ThreadedHeaderHandler,
+    which by default reads files in the default executor of the loop.
+    Control returns to the event loop after every yield_interval output
+    chunks, tokens or with line_output lines.
+    """
+    platform_constants = platform.PLATFORM_CONSTANTS.copy()
+    platform_constants.update(extra_constants)
+    preprocessor = AsyncPreprocessor(
+        line_ending,
+        include_paths,
+        header_handler,
+        constants_to_token_constants(platform_constants),
+        ignore_headers,
+        fold_strings_to_null,
+        int_bits,
+        max_include_depth,
+        line_output,
+        token_output,
+        source_map,
+        compact,
+        yield_interval
+    )
+    return preprocessor.preprocess_async(f_object)
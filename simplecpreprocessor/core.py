@@ -1,9 +1,25 @@
 import enum
+import itertools
+import re
 
 from . import filesystem, tokens, platform, exceptions, expression
+from .headerfilter import HeaderFilter
 from .tokens import TokenType, is_string
 
 
+CONDITIONAL_DIRECTIVES = frozenset(
+    ("if", "ifdef", "ifndef", "elif", "else", "endif")
+)
+# Same as the default nesting limit of GCC
+DEFAULT_MAX_INCLUDE_DEPTH = 200
+# Output fragments handed to each writelines() call
+WRITE_BATCH = 4096
+# Words of a verbatim line that may name a macro
+WORD = re.compile(r"\w+", re.ASCII)
+# Separator of tokens in compact output
+SPACE = tokens.Token(None, " ", TokenType.WHITESPACE, True)
+
+
 class Tag(enum.Enum):
     PRAGMA_ONCE = "#pragma_once"
     IFDEF = "#ifdef"
@@ -57,28 +73,180 @@ class ConditionFrame:
         self.line_no = line_no
         self.branch_taken = False
         self.currently_active = False
+        # Opened by the first non-blank line of its file
+        self.file_start = False
+        # Macro X of an #if !defined(X) include guard
+        self.guard = None
+
+
+class FileFrame:
+    """File being preprocessed on the include stack."""
+
+    def __init__(self, f_object, chunks, closing):
+        self.f_object = f_object
+        self.chunks = chunks
+        # Whether the file was opened for the include and must be closed
+        self.closing = closing
+        # No non-blank chunk seen yet
+        self.leading = True
+        # Condition stack depth at the first non-blank chunk
+        self.opened_at = 0
+        # Digest of the text for the guard database
+        self.digest = None
+        # Includes following each conditional, see include_segments()
+        self.segments = None
+        # Header handler file identity of included files
+        self.identity = None
+        # Condition stack depth when the file was pushed
+        self.conditions = 0
+
+
+def is_blank(chunk):
+    """Return True if chunk has no tokens besides whitespace and newline."""
+    for token in chunk:
+        if not token.whitespace:
+            return False
+    return True
+
+
+def negated_defined(chunk):
+    """Return X if chunk is the expression !defined(X) or !defined X."""
+    values = [token.value for token in chunk if not token.whitespace]
+    if values[:2] != ["!", "defined"]:
+        return None
+    if len(values) == 3:
+        return values[2]
+    if len(values) == 5 and values[2] == "(" and values[4] == ")":
+        return values[3]
+    return None
+
+
+def include_target(chunk):
+    """Return (header, quoted) named by the chunk of an #include, or None."""
+    it = iter(chunk)
+    for first in it:
+        if not first.whitespace:
+            break
+    else:
+        return None
+    if first.type is TokenType.STRING:
+        return first.value[first.value.index('"') + 1:-1], True
+    if first.value == "<":
+        parts = []
+        for token in it:
+            if token.value == ">":
+                return "".join(parts), False
+            parts.append(token.value)
+    return None
+
+
+def include_segments(chunks):
+    """
+    Split the #include chunks of a file at its conditional directives.
+    Returns the includes before the first conditional and a dict from
+    the id of each conditional directive chunk to the includes after it,
+    up to the next conditional.
+    """
+    leading = includes = []
+    segments = {}
+    for chunk in chunks:
+        if chunk[0].value != "#":
+            continue
+        name = chunk[1].value
+        if name == "include":
+            includes.append(chunk)
+        elif name in CONDITIONAL_DIRECTIVES:
+            includes = segments[id(chunk)] = []
+    return leading, segments
 
 
 class Preprocessor:
+    directive_names = (
+        "define", "undef", "include", "if", "ifdef", "ifndef", "elif",
+        "else", "endif", "pragma",
+    )
+    pragma_names = ("once", "pack")
 
     def __init__(self, line_ending=tokens.DEFAULT_LINE_ENDING,
                  include_paths=(), header_handler=None,
                  platform_constants=TOKEN_CONSTANTS,
-                 ignore_headers=(), fold_strings_to_null=False):
-        self.ignore_headers = ignore_headers
+                 ignore_headers=(), fold_strings_to_null=False,
+                 int_bits=None, guard_database=None, prefetch=False,
+                 max_include_depth=DEFAULT_MAX_INCLUDE_DEPTH,
+                 line_output=False, token_output=False, source_map=None,
+                 compact=False, binary=False):
+        self.ignore_headers = HeaderFilter.from_patterns(ignore_headers)
+        self.prefetch = prefetch
+        self.max_include_depth = max_include_depth
         self.include_once = {}
+        self.guard_database = guard_database
         self.defines = Defines(platform_constants)
         self.condition_stack = []
         self.line_ending = line_ending
         self.last_constraint = None
-        self.header_stack = []
+        self.file_stack = []
         self.fold_strings_to_null = fold_strings_to_null
+        self.int_bits = int_bits
         self.token_expander = tokens.TokenExpander(self.defines)
+        # Input files may yield bytes, decoded 1:1 to text
+        self.binary = binary
         if header_handler is None:
-            self.headers = filesystem.HeaderHandler(include_paths)
+            self.headers = filesystem.HeaderHandler(include_paths,
+                                                    binary=binary)
         else:
+            if binary != getattr(header_handler, "binary", False):
+                raise ValueError(
+                    "Header handler binary mode does not match binary=%r"
+                    % binary
+                )
             self.headers = header_handler
             self.headers.add_include_paths(include_paths)
+        # Dispatch tables are built once so that subclass overrides and
+        # registered handlers are found without per-directive lookups
+        self.directives = {
+            name: getattr(self, "process_%s" % name)
+            for name in self.directive_names
+        }
+        self.pragmas = {
+            name: getattr(self, "process_pragma_%s" % name)
+            for name in self.pragma_names
+        }
+        if token_output:
+            self.emit = self._emit_tokens
+        elif line_output:
+            if fold_strings_to_null:
+                self.emit = self._emit_folded_line
+            else:
+                self.emit = self._emit_line
+        elif fold_strings_to_null:
+            self.emit = self._emit_folded
+        else:
+            self.emit = self._emit_values
+        self.source_map = source_map
+        if source_map is not None:
+            self._emit_unmapped = self.emit
+            self.emit = self._emit_mapped
+        # Lines without defined macros are output untokenized unless the
+        # output mode has to look at their tokens
+        self.verbatim = not (fold_strings_to_null or token_output or compact)
+        self.rescanner = tokens.Tokenizer((), line_ending)
+        # Previous compact output line was blank, no blank lines at start
+        self.last_blank = True
+        if compact:
+            self._emit_uncompacted = self.emit
+            self.emit = self._emit_compact
+
+    def register_directive(self, name, handler):
+        """
+        Register handler for #name. It is called with line_no and chunk
+        keyword arguments in active blocks and may return an iterable of
+        output text.
+        """
+        self.directives[name] = handler
+
+    def register_pragma(self, name, handler):
+        """Register handler for #pragma name, called like directives."""
+        self.pragmas[name] = handler
 
     def _should_ignore(self):
         """Check if we should ignore content at the current nesting level."""
@@ -88,16 +256,20 @@ class Preprocessor:
         return False
 
     def process_define(self, **kwargs):
-        if self._should_ignore():
+        define_name, value = self._parse_define(kwargs["chunk"])
+        if define_name is None:  # pragma: no cover
             return
-        chunk = kwargs["chunk"]
+        self.defines[define_name] = value
+
+    def _parse_define(self, chunk):
+        """Parse a #define body into (name, replacement) pair."""
         for i, tokenized in enumerate(chunk):
             if not tokenized.whitespace:
                 define_name = tokenized.value
                 break
         else:  # pragma: no cover
             # Defensive: should never happen as tokenizer ensures non-ws tokens
-            return
+            return None, None
 
         # Check if this is a function-like macro
         # Function-like macros have '(' immediately after name (no whitespace)
@@ -131,10 +303,7 @@ class Preprocessor:
                                chunk[body_start].whitespace):
                             body_start += 1
                         body = chunk[body_start:-1]  # Exclude newline
-                        self.defines[define_name] = FunctionLikeMacro(
-                            params, body
-                        )
-                        return
+                        return define_name, FunctionLikeMacro(params, body)
                     else:
                         paren_depth -= 1
                 elif token.value == "," and paren_depth == 0:
@@ -154,17 +323,14 @@ class Preprocessor:
             # Fall through to object-like macro handling
 
         # Object-like macro
-        self.defines[define_name] = chunk[i+2:-1]
+        return define_name, chunk[i+2:-1]
 
     def process_endif(self, **kwargs):
         line_no = kwargs["line_no"]
         if not self.condition_stack:
             fmt = "Unexpected #endif on line %s"
             raise exceptions.ParseError(fmt % line_no)
-        frame = self.condition_stack.pop()
-        self.last_constraint = (
-            frame.condition, frame.tag, frame.line_no
-        )
+        self.last_constraint = self.condition_stack.pop()
 
     def process_else(self, **kwargs):
         line_no = kwargs["line_no"]
@@ -217,8 +383,7 @@ class Preprocessor:
         token = None
         for token in chunk:
             if not token.whitespace:
-                method_name = "process_pragma_%s" % token.value
-                pragma = getattr(self, method_name, None)
+                pragma = self.pragmas.get(token.value)
                 break
         if pragma is None:
             if token is None:  # pragma: no cover
@@ -236,15 +401,26 @@ class Preprocessor:
                 yield from ret
 
     def process_pragma_once(self, **_):
-        self.include_once[self.current_name()] = Tag.PRAGMA_ONCE
+        self._record_guard(self.current_name(), Tag.PRAGMA_ONCE)
+
+    def _record_guard(self, name, guard):
+        identity = self.headers.file_identity(name)
+        self.include_once[identity] = guard
+        if self.guard_database is not None:
+            self.guard_database.record(
+                name, guard, identity, self.file_stack[-1].digest,
+                self.binary
+            )
 
-    def process_pragma_pack(self, chunk, **_):
-        yield "#pragma"
-        for token in chunk:
-            yield token.value
+    def process_pragma_pack(self, chunk, line_no, **_):
+        directive = [
+            tokens.Token.from_string(line_no, "#", TokenType.SYMBOL),
+            tokens.Token.from_string(line_no, "pragma", TokenType.IDENTIFIER),
+        ]
+        return self.emit(directive + chunk)
 
     def current_name(self):
-        return self.header_stack[-1].name
+        return self.file_stack[-1].f_object.name
 
     def process_ifndef(self, **kwargs):
         chunk = kwargs["chunk"]
@@ -282,13 +458,16 @@ class Preprocessor:
         chunk = kwargs["chunk"]
         line_no = kwargs["line_no"]
         try:
-            result = expression.evaluate_expression(chunk, self.defines)
+            result = expression.evaluate_expression(
+                chunk, self.defines, self.int_bits
+            )
             condition_met = result != 0
         except (SyntaxError, ZeroDivisionError) as e:
             fmt = "Error evaluating #if on line %s: %s"
             raise exceptions.ParseError(fmt % (line_no, str(e)))
 
         frame = ConditionFrame(Tag.IF, result, line_no)
+        frame.guard = negated_defined(chunk)
         parent_ignoring = self._should_ignore()
 
         if not parent_ignoring and condition_met:
@@ -320,7 +499,9 @@ class Preprocessor:
 
         # No previous branch taken, evaluate this elif's condition
         try:
-            result = expression.evaluate_expression(chunk, self.defines)
+            result = expression.evaluate_expression(
+                chunk, self.defines, self.int_bits
+            )
             condition_met = result != 0
         except (SyntaxError, ZeroDivisionError) as e:
             fmt = "Error evaluating #elif on line %s: %s"
@@ -346,15 +527,94 @@ class Preprocessor:
         return False
 
     def process_source_chunks(self, chunk):
-        if not self._should_ignore():
-            for token in self.token_expander.expand_tokens(chunk):
-                if self.fold_strings_to_null and is_string(token):
-                    yield "NULL"
-                else:
-                    yield token.value
+        if self._should_ignore():
+            return ()
+        token = chunk[0]
+        if token.type is TokenType.VERBATIM:
+            text = token.value
+            if self.defines.defines.keys().isdisjoint(WORD.findall(text)):
+                if self.source_map is not None:
+                    self.source_map.add(
+                        self.source_map.file_id(self.current_name()),
+                        token.line_no + 1
+                    )
+                return (text,)
+            chunk = self.rescanner.rescan(token.line_no, text)
+        return self.emit(self.token_expander.expand_tokens(chunk))
+
+    def _emit_values(self, expanded):
+        for token in expanded:
+            yield token.value
+
+    def _emit_folded(self, expanded):
+        for token in expanded:
+            if is_string(token):
+                yield "NULL"
+            else:
+                yield token.value
+
+    def _emit_line(self, expanded):
+        return ("".join([token.value for token in expanded]),)
+
+    def _emit_folded_line(self, expanded):
+        return ("".join([
+            "NULL" if is_string(token) else token.value
+            for token in expanded
+        ]),)
+
+    def _emit_tokens(self, expanded):
+        expanded = list(expanded)
+        # Output lines end with the newline token of their source line
+        return (
+            tokens.TokenBatch(
+                self.current_name(), expanded[-1].line_no, expanded
+            ),
+        )
+
+    def _emit_compact(self, expanded):
+        compacted = []
+        blank = True
+        separate = False
+        for token in expanded:
+            if token.type is TokenType.NEWLINE:
+                compacted.append(token)
+                separate = False
+            elif token.whitespace:
+                # Any run of whitespace between tokens becomes one space
+                separate = (
+                    separate or bool(compacted)
+                    and compacted[-1].type is not TokenType.NEWLINE
+                )
+            else:
+                if separate:
+                    compacted.append(SPACE)
+                    separate = False
+                compacted.append(token)
+                blank = False
+        if blank:
+            if self.last_blank:
+                return ()
+            del compacted[1:]
+        self.last_blank = blank
+        return self._emit_uncompacted(compacted)
+
+    def _emit_mapped(self, expanded):
+        expanded = list(expanded)
+        source_map = self.source_map
+        file_id = source_map.file_id(self.current_name())
+        for token in expanded:
+            if token.type is TokenType.NEWLINE:
+                source_map.add(file_id, token.line_no + 1)
+        return self._emit_unmapped(expanded)
 
     def skip_file(self, name):
-        item = self.include_once.get(name)
+        identity = self.headers.file_identity(name)
+        item = self.include_once.get(identity)
+        if item is None and self.guard_database is not None:
+            item = self.guard_database.lookup(name, identity, self.binary)
+            if item is Tag.PRAGMA_ONCE:
+                # Only files already included in this run are skipped
+                return False
         if item is Tag.PRAGMA_ONCE:
             return True
         elif item is None:
@@ -373,9 +633,91 @@ class Preprocessor:
             if f is None:
                 raise error
             elif f is not filesystem.SKIP_FILE:
-                with f:
-                    for chunk in self.preprocess(f):
-                        yield chunk
+                self.push_file(f)
+
+    def _include_chain_error(self, f_object, identity):
+        names = [frame.f_object.name for frame in self.file_stack]
+        names.append(f_object.name)
+        identities = [frame.identity for frame in self.file_stack]
+        identities.append(identity)
+        start = identities.index(identity)
+        if start < len(names) - 1:
+            fmt = "Include cycle %s exceeds include depth limit %s"
+            chain = names[start:]
+        else:
+            fmt = "Include chain %s exceeds include depth limit %s"
+            chain = names
+        return exceptions.ParseError(
+            fmt % (" -> ".join(chain), self.max_include_depth)
+        )
+
+    def _unconditional_cycle(self, identity):
+        """
+        Return the names of the files from an earlier inclusion of the
+        file identity to the current file if every one of them included
+        the next outside its own conditionals, so that including it again
+        would repeat forever. Otherwise return None.
+        """
+        depth = len(self.condition_stack)
+        for index in range(len(self.file_stack) - 1, -1, -1):
+            frame = self.file_stack[index]
+            if frame.conditions != depth:
+                return None
+            if frame.identity == identity:
+                return [
+                    frame.f_object.name for frame in self.file_stack[index:]
+                ]
+        return None
+
+    def push_file(self, f_object, closing=True):
+        """
+        Make f_object the file being preprocessed. The driver loop of
+        preprocess() continues with it and returns to the including file
+        at its end. If closing is set the file is closed when done.
+        """
+        identity = None
+        if closing:
+            identity = self.headers.file_identity(f_object.name)
+            if len(self.file_stack) >= self.max_include_depth:
+                with f_object:
+                    raise self._include_chain_error(f_object, identity)
+            cycle = self._unconditional_cycle(identity)
+            if cycle is not None:
+                with f_object:
+                    raise exceptions.ParseError(
+                        "Include cycle %s is not stopped by a guard or "
+                        "conditional" % " -> ".join(cycle + [f_object.name])
+                    )
+            f_object.__enter__()
+        frame = FileFrame(f_object, None, closing)
+        frame.identity = identity
+        frame.conditions = len(self.condition_stack)
+        self.file_stack.append(frame)
+        source = f_object
+        if self.guard_database is not None:
+            # Guards are recorded with a digest of the text read here
+            text = filesystem.read_text(f_object)
+            frame.digest = filesystem.text_digest(text)
+            if not isinstance(f_object, filesystem.MemoryFile):
+                source = filesystem.MemoryFile(f_object.name, text)
+        chunks = self.headers.read_chunks(
+            source, self.line_ending, self.verbatim
+        )
+        if self.prefetch:
+            # Includes are prefetched once their block turns out active
+            chunks = list(chunks)
+            leading, frame.segments = include_segments(chunks)
+            self.prefetch_includes(leading)
+        frame.chunks = iter(chunks)
+        return frame
+
+    def pop_file(self):
+        """Finish the file being preprocessed."""
+        self.check_fullfile_guard()
+        frame = self.file_stack.pop()
+        if frame.closing:
+            frame.f_object.__exit__(None, None, None)
+        return frame
 
     def process_include(self, **kwargs):
         chunk = kwargs["chunk"]
@@ -454,43 +796,112 @@ class Preprocessor:
         raise exceptions.ParseError(fmt)
 
     def check_fullfile_guard(self):
-        if self.last_constraint is None:
+        """
+        Record an include guard if the file consists of a single
+        conditional block apart from blank lines and comments.
+        """
+        frame = self.last_constraint
+        self.last_constraint = None
+        if frame is None or not frame.file_start:
             return
-        constraint, constraint_type, begin = self.last_constraint
-        if begin != 0:
+        if frame.tag is Tag.IF and frame.guard is not None:
+            guard = frame.guard, Tag.IFNDEF
+        elif frame.tag is Tag.IFDEF or frame.tag is Tag.IFNDEF:
+            guard = frame.condition, frame.tag
+        else:
+            # Blocks with #else or #elif are not guards
             return
-        self.include_once[self.current_name()] = constraint, constraint_type
+        self._record_guard(self.current_name(), guard)
+
+    def prefetch_includes(self, chunks):
+        """Ask the header handler to prefetch the #include chunks."""
+        anchor_file = self.current_name()
+        for chunk in chunks:
+            target = include_target(chunk[2:])
+            if target is None or target[0] in self.ignore_headers:
+                continue
+            header, quoted = target
+            self.headers.prefetch(
+                header, self.skip_file, anchor_file if quoted else None,
+                self.line_ending, self.verbatim
+            )
+
+    def unsupported_directive(self, name, line_no, chunk):
+        fmt = (
+            "Line number %s contains unsupported macro %s"
+            % (line_no, name)
+        )
+        raise exceptions.ParseError(fmt)
 
     def preprocess(self, f_object, depth=0):
-        self.header_stack.append(f_object)
-        tokenizer = tokens.Tokenizer(f_object, self.line_ending)
-        for chunk in tokenizer.read_chunks():
-            self.last_constraint = None
-            if chunk[0].value == "#":
-                line_no = chunk[0].line_no
-                macro_name = chunk[1].value
-                macro_chunk = chunk[2:]
-                macro = getattr(
-                    self,
-                    "process_%s" % macro_name,
-                    None
-                )
-                if macro is None:
-                    fmt = (
-                        "Line number %s contains unsupported macro %s"
-                        % (line_no, macro_name)
-                    )
-                    raise exceptions.ParseError(fmt)
-                ret = macro(line_no=line_no, chunk=macro_chunk)
-                if ret is not None:
-                    for token in ret:
-                        yield token
-            else:
-                for token in self.process_source_chunks(chunk):
-                    yield token
-        self.check_fullfile_guard()
-        self.header_stack.pop()
-        if not self.header_stack and self.condition_stack:
+        # Included files are pushed on file_stack rather than preprocessed
+        # recursively, so every token is yielded from this one generator
+        base = len(self.file_stack)
+        if self.binary:
+            f_object = filesystem.BinaryFile(f_object)
+        self.push_file(f_object, closing=False)
+        directives = self.directives
+        try:
+            while len(self.file_stack) > base:
+                frame = self.file_stack[-1]
+                for chunk in frame.chunks:
+                    if (
+                        self.last_constraint is not None
+                        and not is_blank(chunk)
+                    ):
+                        self.last_constraint = None
+                    first = False
+                    if frame.leading and not is_blank(chunk):
+                        frame.leading = False
+                        first = True
+                        frame.opened_at = len(self.condition_stack)
+                    if chunk[0].value == "#":
+                        line_no = chunk[0].line_no
+                        macro_name = chunk[1].value
+                        macro_chunk = chunk[2:]
+                        if (
+                            macro_name not in CONDITIONAL_DIRECTIVES
+                            and self._should_ignore()
+                        ):
+                            # Only conditionals matter inside skipped blocks
+                            continue
+                        macro = directives.get(macro_name)
+                        if macro is None:
+                            ret = self.unsupported_directive(
+                                macro_name, line_no, macro_chunk
+                            )
+                        else:
+                            ret = macro(line_no=line_no, chunk=macro_chunk)
+                        if ret is not None:
+                            for token in ret:
+                                yield token
+                        if frame.segments is not None:
+                            includes = frame.segments.get(id(chunk))
+                            if includes and not self._should_ignore():
+                                self.prefetch_includes(includes)
+                        if (
+                            first
+                            and len(self.condition_stack) > frame.opened_at
+                        ):
+                            self.condition_stack[-1].file_start = True
+                        if self.file_stack[-1] is not frame:
+                            # Directive included a file, continue with it
+                            break
+                    else:
+                        for token in self.process_source_chunks(chunk):
+                            yield token
+                else:
+                    self.pop_file()
+        finally:
+            # Close included files left open by an error
+            while len(self.file_stack) > base:
+                frame = self.file_stack.pop()
+                if frame.closing:
+                    frame.f_object.__exit__(None, None, None)
+            if self.prefetch and not self.file_stack:
+                # Prefetches of includes never reached may go stale
+                self.headers.cancel_prefetches()
+        if not self.file_stack and self.condition_stack:
             frame = self.condition_stack[-1]
             fmt = (
                 "{tag} {name} from line {line_no} left open"
@@ -506,10 +917,30 @@ class Preprocessor:
 def preprocess(f_object, line_ending="\n", include_paths=(),
                header_handler=None,
                extra_constants=(),
-               ignore_headers=(), fold_strings_to_null=False):
+               ignore_headers=(), fold_strings_to_null=False,
+               int_bits=None, guard_database=None, prefetch=False,
+               max_include_depth=DEFAULT_MAX_INCLUDE_DEPTH,
+               line_output=False, token_output=False, source_map=None,
+               compact=False, binary=False):
     """
     This preprocessor yields chunks of text that combined result in lines
     delimited with the given line ending. There is always a final line ending.
+    If int_bits is given (eg 64), #if expressions are evaluated in
+    intmax_t/uintmax_t of that width with C wraparound semantics.
+    A guards.GuardDatabase given as guard_database remembers include
+    guards across runs. With prefetch, includes are read and tokenized
+    ahead of time in a thread pool of the header handler. ignore_headers
+    takes header names, globs and re: patterns or a compiled
+    headerfilter.HeaderFilter. Includes nested deeper than
+    max_include_depth raise a ParseError naming the include chain. With
+    line_output, one string is yielded per output line instead of one per
+    token. With token_output, a tokens.TokenBatch of expanded tokens with
+    their origin is yielded per output line instead. A
+    sourcemap.SourceMap given as source_map records the origin of each
+    output line. With compact, runs of whitespace are coalesced into one
+    space and runs of blank lines into one blank line. With binary,
+    f_object and headers are read as bytes which are passed through
+    unchanged whatever their encoding, see preprocess_to_file.
     """
     platform_constants = platform.PLATFORM_CONSTANTS.copy()
     platform_constants.update(extra_constants)
@@ -519,6 +950,53 @@ def preprocess(f_object, line_ending="\n", include_paths=(),
         header_handler,
         constants_to_token_constants(platform_constants),
         ignore_headers,
-        fold_strings_to_null
+        fold_strings_to_null,
+        int_bits,
+        guard_database,
+        prefetch,
+        max_include_depth,
+        line_output,
+        token_output,
+        source_map,
+        compact,
+        binary
     )
     return preprocessor.preprocess(f_object)
+
+
+def _preprocess_lines(f_object, kwargs):
+    if kwargs.get("token_output"):
+        raise ValueError(
+            "token_output yields TokenBatch objects, use preprocess()"
+        )
+    kwargs["line_output"] = True
+    return preprocess(f_object, **kwargs)
+
+
+def preprocess_to_string(f_object, **kwargs):
+    """
+    Preprocess f_object eagerly and return the output as one string.
+    Takes the same keyword arguments as preprocess() apart from
+    token_output, which raises ValueError.
+    """
+    return "".join(_preprocess_lines(f_object, kwargs))
+
+
+def preprocess_to_file(f_object, output, **kwargs):
+    """
+    Preprocess f_object eagerly into the file object output, writing the
+    output in batches of lines. Takes the same keyword arguments as
+    preprocess() apart from token_output, which raises ValueError. With
+    binary, output must be a binary file and gets the original bytes of
+    the input.
+    """
+    lines = _preprocess_lines(f_object, kwargs)
+    binary = kwargs.get("binary", False)
+    while True:
+        batch = list(itertools.islice(lines, WRITE_BATCH))
+        if not batch:
+            break
+        if binary:
+            output.write("".join(batch).encode(filesystem.BINARY_ENCODING))
+        else:
+            output.writelines(batch)
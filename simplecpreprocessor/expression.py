@@ -2,6 +2,44 @@
 Expression parser for C preprocessor #if and #elif directives.
 Uses a Pratt parser for operator precedence parsing.
 """
+import re
+
+INTEGER_LITERAL = re.compile(
+    r"(0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)"
+    r"([uU](?:ll|LL|l|L)?|(?:ll|LL|l|L)[uU]?)?$"
+)
+TRUTH_VALUED_OPS = frozenset(
+    ("||", "&&", "==", "!=", "<", ">", "<=", ">=")
+)
+
+
+class UnsignedInt(int):
+    """Integer of unsigned type (uintmax_t) in fixed-width evaluation."""
+
+
+def parse_integer_literal(text):
+    """
+    Parse a C integer literal with optional U/L/UL/ULL suffix.
+
+    Returns (value, unsigned) or None if text is not an integer literal.
+    Octal literals with digits 8 or 9 raise SyntaxError.
+    """
+    match = INTEGER_LITERAL.match(text)
+    if match is None:
+        return None
+    digits, suffix = match.groups()
+    if digits[:2] in ("0x", "0X"):
+        value = int(digits[2:], 16)
+    elif digits[:2] in ("0b", "0B"):
+        value = int(digits[2:], 2)
+    elif len(digits) > 1 and digits[0] == "0":
+        try:
+            value = int(digits, 8)
+        except ValueError:
+            raise SyntaxError("Invalid digit in octal constant %s" % text)
+    else:
+        value = int(digits)
+    return value, suffix is not None and suffix[0] in "uU"
 
 
 class ExpressionToken:
@@ -74,16 +112,25 @@ class ExpressionParser:
     Supports: integers, defined(), logical ops, comparison, arithmetic.
     """
 
-    def __init__(self, tokens, defines):
+    def __init__(self, tokens, defines, int_bits=None):
         """
         Initialize parser.
 
         Args:
             tokens: List of Token objects from preprocessor
             defines: Defines object to check for macro definitions
+            int_bits: Width of intmax_t/uintmax_t for C wraparound
+                arithmetic, or None for unbounded integers
         """
         self.lexer = ExpressionLexer(tokens)
         self.defines = defines
+        self.int_bits = int_bits
+        if int_bits is None:
+            self._binary_op = self._apply_binary_op
+        else:
+            self._mask = (1 << int_bits) - 1
+            self._sign_bit = 1 << (int_bits - 1)
+            self._binary_op = self._apply_fixed_binary_op
 
     def parse(self):
         """Parse and evaluate the expression, returning an integer."""
@@ -94,11 +141,16 @@ class ExpressionParser:
             raise SyntaxError(
                 f"Unexpected token: {self.lexer.peek().value}"
             )
-        return result
+        return int(result)
 
-    def _parse_expr(self, min_precedence):
-        """Parse expression with precedence climbing."""
-        left = self._parse_primary()
+    def _parse_expr(self, min_precedence, evaluate=True):
+        """
+        Parse expression with precedence climbing.
+
+        When evaluate is False the expression is only parsed, which is how
+        the operand skipped by a short-circuiting && or || is consumed.
+        """
+        left = self._parse_primary(evaluate)
 
         while (token := self.lexer.peek()) is not None:
             op = token.value
@@ -111,12 +163,21 @@ class ExpressionParser:
                 break
 
             self.lexer.consume()
-            right = self._parse_expr(precedence + 1)
-            left = self._apply_binary_op(op, left, right)
+            if not evaluate:
+                self._parse_expr(precedence + 1, False)
+            elif op == "&&" and not left:
+                self._parse_expr(precedence + 1, False)
+                left = 0
+            elif op == "||" and left:
+                self._parse_expr(precedence + 1, False)
+                left = 1
+            else:
+                right = self._parse_expr(precedence + 1)
+                left = self._binary_op(op, left, right)
 
         return left
 
-    def _parse_primary(self):
+    def _parse_primary(self, evaluate=True):
         """Parse primary expression (numbers, defined, unary, parens)."""
         token = self.lexer.peek()
         if token is None:
@@ -125,7 +186,7 @@ class ExpressionParser:
         # Handle parentheses
         if token.value == "(":
             self.lexer.consume()
-            result = self._parse_expr(0)
+            result = self._parse_expr(0, evaluate)
             closing = self.lexer.peek()
             if closing is None or closing.value != ")":
                 raise SyntaxError("Missing closing parenthesis")
@@ -136,29 +197,38 @@ class ExpressionParser:
         if token.value in ("!", "+", "-"):
             op = token.value
             self.lexer.consume()
-            operand = self._parse_primary()
-            if op == "!":
+            operand = self._parse_primary(evaluate)
+            if not evaluate:
+                return 0
+            elif op == "!":
                 return 0 if operand else 1
             elif op == "-":
-                return -operand
+                if self.int_bits is None:
+                    return -operand
+                return self._wrap(-operand, isinstance(operand, UnsignedInt))
             else:  # +
                 return operand
 
         # Handle defined() operator
         if token.value == "defined":
-            return self._parse_defined()
+            return self._parse_defined(evaluate)
 
         # Handle integer literals
-        try:
-            value = int(token.value)
+        if not evaluate:
             self.lexer.consume()
-            return value
-        except ValueError:
+            return 0
+        self.lexer.consume()
+        literal = parse_integer_literal(token.value)
+        if literal is None:
             # Undefined identifier evaluates to 0
-            self.lexer.consume()
             return 0
+        value, unsigned = literal
+        if self.int_bits is None:
+            return value
+        # Literals that do not fit intmax_t have type uintmax_t
+        return self._wrap(value, unsigned or value > self._mask >> 1)
 
-    def _parse_defined(self):
+    def _parse_defined(self, evaluate=True):
         """Parse defined(MACRO) or defined MACRO."""
         self.lexer.consume()  # consume 'defined'
 
@@ -182,6 +252,8 @@ class ExpressionParser:
                 raise SyntaxError("Missing closing paren in defined()")
             self.lexer.consume()
 
+        if not evaluate:
+            return 0
         return 1 if macro_name in self.defines else 0
 
     def _get_precedence(self, op):
@@ -240,17 +312,53 @@ class ExpressionParser:
         else:  # pragma: no cover
             raise SyntaxError(f"Unknown operator: {op}")
 
+    def _wrap(self, value, unsigned):
+        """Reduce value modulo 2**int_bits into the signed/unsigned range."""
+        value &= self._mask
+        if unsigned:
+            return UnsignedInt(value)
+        if value & self._sign_bit:
+            value -= self._mask + 1
+        return value
+
+    def _apply_fixed_binary_op(self, op, left, right):
+        """Apply binary operator with intmax_t/uintmax_t semantics."""
+        unsigned = (
+            isinstance(left, UnsignedInt) or isinstance(right, UnsignedInt)
+        )
+        if unsigned:
+            # Usual arithmetic conversions: both operands become unsigned
+            left &= self._mask
+            right &= self._mask
+        if op in ("/", "%"):
+            if right == 0:
+                raise ZeroDivisionError(
+                    "Division by zero" if op == "/" else "Modulo by zero"
+                )
+            # C division truncates toward zero
+            quotient = abs(left) // abs(right)
+            if (left < 0) != (right < 0):
+                quotient = -quotient
+            result = quotient if op == "/" else left - quotient * right
+        else:
+            result = self._apply_binary_op(op, left, right)
+        if op in TRUTH_VALUED_OPS:
+            return result
+        return self._wrap(result, unsigned)
+
 
-def evaluate_expression(tokens, defines):
+def evaluate_expression(tokens, defines, int_bits=None):
     """
     Evaluate a C preprocessor constant expression.
 
     Args:
         tokens: List of Token objects from the preprocessor
         defines: Defines object to check for macro definitions
+        int_bits: Width of intmax_t/uintmax_t (eg 64) to evaluate with C
+            wraparound semantics, or None for unbounded integers
 
     Returns:
         Integer result of the expression (non-zero = true, 0 = false)
     """
-    parser = ExpressionParser(tokens, defines)
+    parser = ExpressionParser(tokens, defines, int_bits)
     return parser.parse()
@@ -1,51 +1,686 @@
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
 import posixpath
+import os
 import os.path
+import sys
+import tarfile
+import threading
+import zipfile
+
+from . import tokens
 
 SKIP_FILE = object()
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_PREFETCH_WORKERS = 4
+# Maps every byte to one character, so any encoding passes through unchanged
+BINARY_ENCODING = "latin-1"
+# File names are case-insensitive by default on Windows and macOS
+CASE_SENSITIVE = not (
+    os.path.normcase("A") == "a" or sys.platform == "darwin"
+)
+
+
+class MemoryFile(object):
+    """Read-only file object over header text held in memory."""
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.lines = None
+
+    def __iter__(self):
+        # Split once, the same file may be opened many times
+        if self.lines is None:
+            self.lines = io.StringIO(self.text).readlines()
+        return iter(self.lines)
+
+    def read(self):
+        return self.text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def read_text(f_object):
+    """Return the whole text of f_object."""
+    if isinstance(f_object, MemoryFile):
+        return f_object.text
+    return "".join(f_object)
+
+
+def text_digest(text):
+    """Hex digest identifying the contents of a file read as text."""
+    return hashlib.sha1(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def stat_identity(name):
+    """
+    Device and inode of the file, or its real path where the file system
+    has no inode numbers or the file does not exist.
+    """
+    try:
+        st = os.stat(name)
+    except OSError:
+        st = None
+    if st is not None and st.st_ino:
+        return st.st_dev, st.st_ino
+    return os.path.realpath(name)
+
+
+class BinaryFile(object):
+    """
+    Text view of a file object yielding bytes lines, decoded with
+    BINARY_ENCODING. Lines that are already text are passed through.
+    """
+
+    def __init__(self, f_object):
+        self.f_object = f_object
+        self.name = f_object.name
+
+    def __iter__(self):
+        for line in self.f_object:
+            if isinstance(line, str):
+                yield line
+            else:
+                yield str(line, BINARY_ENCODING)
+
+
+class PrefetchedFile(MemoryFile):
+    """Header read and tokenized ahead of time by HeaderHandler.prefetch."""
+
+    def __init__(self, name, text, chunks, line_ending, verbatim):
+        super(PrefetchedFile, self).__init__(name, text)
+        self.chunks = chunks
+        self.line_ending = line_ending
+        self.verbatim = verbatim
+
+
+class ContentCache(object):
+    """
+    LRU cache of header contents limited to max_bytes of file size, keyed
+    by file identity.
+    Entries are validated against file modification time and size, and
+    the cache may be shared between handlers and threads.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, stat_key):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != stat_key:
+                return None
+            self.entries.move_to_end(path)
+            return entry[1]
+
+    def put(self, path, stat_key, text):
+        size = stat_key[1]
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[0][1]
+            if size > self.max_bytes:
+                return
+            self.entries[path] = stat_key, text
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (evicted_key, _) = self.entries.popitem(last=False)
+                self.size -= evicted_key[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class TokenCache(object):
+    """
+    LRU cache of tokenized files keyed by a hash of their contents, so
+    that byte-identical headers at different paths are tokenized once.
+    Limited to max_bytes of source text and safe to share between
+    handlers and threads.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def read_chunks(self, text, line_ending, verbatim=False):
+        digest = hashlib.sha1(
+            text.encode("utf-8", "surrogatepass")
+        ).digest()
+        key = digest, line_ending, verbatim
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[1]
+        tokenizer = tokens.Tokenizer(io.StringIO(text), line_ending, verbatim)
+        chunks = list(tokenizer.read_chunks())
+        size = len(text)
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = size, chunks
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (evicted_size, _) = self.entries.popitem(last=False)
+                    self.size -= evicted_size
+        return chunks
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
 
 
 class HeaderHandler(object):
 
-    def __init__(self, include_paths):
+    def __init__(self, include_paths, content_cache=None, token_cache=None,
+                 executor=None, binary=False):
         self.include_paths = list(include_paths)
+        # In binary mode headers are read as bytes mapped 1:1 to text
+        self.binary = binary
+        self.encoding = BINARY_ENCODING if binary else None
+        # Lines end only at "\n" and no newlines are translated
+        self.newline = "\n" if binary else None
+        self.content_cache = content_cache
+        self.token_cache = token_cache
+        # Pool for prefetch(), created on first use if not given
+        self.executor = executor
+        self.owns_executor = executor is None
+        # Resolution cache key -> future of a PrefetchedFile or None
+        self.pending = {}
+        # Explicitly pre-resolved include names
         self.resolved = {}
+        # (search start directory, header, quoted) -> path or None on miss
+        self.resolution_cache = {}
+        # Candidate paths that failed to open
+        self.missing = set()
+        # Path -> canonical file identity
+        self.identities = {}
 
     def _open(self, header_path):
+        if self.content_cache is not None:
+            return self._open_cached(header_path)
         try:
-            f = open(header_path)
+            f = open(header_path, encoding=self.encoding,
+                     newline=self.newline)
         except IOError:
             return None
         else:
             return f
 
+    def file_identity(self, name):
+        """
+        Return a canonical identity for the file, the same for every path
+        that reaches it through symlinks or .. segments. Used as the key of
+        #pragma once and include guard tracking.
+        """
+        try:
+            return self.identities[name]
+        except KeyError:
+            identity = self.identities[name] = stat_identity(name)
+            return identity
+
+    def read_chunks(self, f_object, line_ending, verbatim=False):
+        """
+        Return the token chunks of f_object. With a token cache, files
+        with identical contents share one tokenization.
+        """
+        if (
+            isinstance(f_object, PrefetchedFile)
+            and f_object.line_ending == line_ending
+            and f_object.verbatim == verbatim
+        ):
+            return iter(f_object.chunks)
+        if self.token_cache is None:
+            tokenizer = tokens.Tokenizer(f_object, line_ending, verbatim)
+            return tokenizer.read_chunks()
+        return self.token_cache.read_chunks(
+            read_text(f_object), line_ending, verbatim
+        )
+
+    def _open_cached(self, header_path):
+        try:
+            st = os.stat(header_path)
+            identity = st.st_dev, st.st_ino, self.encoding
+            stat_key = st.st_mtime_ns, st.st_size
+            text = self.content_cache.get(identity, stat_key)
+            if text is None:
+                with open(header_path, encoding=self.encoding,
+                          newline=self.newline) as f:
+                    text = f.read()
+                self.content_cache.put(identity, stat_key, text)
+        except IOError:
+            return None
+        return MemoryFile(header_path, text)
+
     def add_include_paths(self, include_paths):
-        self.include_paths.extend(include_paths)
-
-    def _resolve(self, anchor_file):
-        if anchor_file is not None:
-            if os.path.sep != posixpath.sep:
-                anchor_file = anchor_file.replace(os.path.sep,
-                                                  posixpath.sep)
-            yield posixpath.dirname(anchor_file)
+        include_paths = list(include_paths)
+        if include_paths:
+            self.include_paths.extend(include_paths)
+            # Known misses, identities and directory listings stay valid
+            self.resolution_cache.clear()
+            self.pending.clear()
+
+    def invalidate(self, include_header=None):
+        """
+        Forget cached resolutions and misses, either all of them or the
+        resolutions of include_header. Call this when files are added or
+        removed under the include paths.
+        """
+        if include_header is None:
+            self.resolution_cache.clear()
+            self.identities.clear()
+            self.pending.clear()
+        else:
+            for key in list(self.resolution_cache):
+                if key[1] == include_header:
+                    del self.resolution_cache[key]
+        self.missing.clear()
+
+    def _anchor_directory(self, anchor_file):
+        if anchor_file is None:
+            return None
+        if os.path.sep != posixpath.sep:
+            anchor_file = anchor_file.replace(os.path.sep, posixpath.sep)
+        return posixpath.dirname(anchor_file)
+
+    def _resolve(self, anchor_directory):
+        if anchor_directory is not None:
+            yield anchor_directory
         for include_path in self.include_paths:
             yield include_path
 
+    def _search(self, include_header, anchor_directory, skip_file):
+        """
+        Return (path, file) for the first candidate that exists, with
+        SKIP_FILE as file if skip_file says so, or (None, None).
+        """
+        missing = self.missing
+        for include_path in self._resolve(anchor_directory):
+            header_path = posixpath.normpath(
+                posixpath.join(include_path, include_header)
+            )
+            if header_path in missing:
+                continue
+            exists = self._exists(header_path)
+            if exists:
+                # Known guards are checked before the file is opened
+                if skip_file(header_path):
+                    return header_path, SKIP_FILE
+            elif exists is not None:
+                missing.add(header_path)
+                continue
+            f = self._open(header_path)
+            if f:
+                if exists is None and skip_file(header_path):
+                    with f:
+                        return header_path, SKIP_FILE
+                return header_path, f
+            missing.add(header_path)
+        return None, None
+
+    def _exists(self, header_path):
+        """
+        Whether header_path exists if that is known without system
+        calls, otherwise None and the file is opened to find out.
+        """
+        return None
+
+    def prefetch(self, include_header, skip_file, anchor_file, line_ending,
+                 verbatim=False):
+        """
+        Start resolving, reading and tokenizing include_header in the
+        background. The result is used by a later open_header() call for
+        the same include. Headers that skip_file says are already done are
+        not prefetched.
+        """
+        anchor_directory = self._anchor_directory(anchor_file)
+        key = (anchor_directory, include_header, anchor_file is not None)
+        if key in self.pending:
+            return
+        header_path = self.resolved.get(include_header)
+        if header_path is None and key in self.resolution_cache:
+            header_path = self.resolution_cache[key]
+            if header_path is None:
+                return
+        if header_path is not None:
+            if skip_file(header_path):
+                return
+            candidates = [header_path]
+        else:
+            # Candidates are computed here as the caches are not locked
+            candidates = []
+            for include_path in self._resolve(anchor_directory):
+                candidate = posixpath.normpath(
+                    posixpath.join(include_path, include_header)
+                )
+                if candidate not in self.missing:
+                    candidates.append(candidate)
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                DEFAULT_PREFETCH_WORKERS
+            )
+        self.pending[key] = self.executor.submit(
+            self._prefetch_job, candidates, line_ending, verbatim
+        )
+
+    def _prefetch_job(self, candidates, line_ending, verbatim=False):
+        for header_path in candidates:
+            f = self._open(header_path)
+            if f:
+                break
+        else:
+            return None
+        with f:
+            return self.load(f, line_ending, verbatim)
+
+    def load(self, f_object, line_ending, verbatim=False):
+        """Read and tokenize f_object into a PrefetchedFile."""
+        text = read_text(f_object)
+        chunks = list(self.read_chunks(
+            MemoryFile(f_object.name, text), line_ending, verbatim
+        ))
+        return PrefetchedFile(
+            f_object.name, text, chunks, line_ending, verbatim
+        )
+
+    def cancel_prefetches(self):
+        """Drop prefetches that were not used by open_header()."""
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            future.cancel()
+
+    def close(self):
+        """Shut down the prefetch pool if the handler created it."""
+        self.pending.clear()
+        if self.owns_executor and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _take_prefetched(self, key):
+        future = self.pending.pop(key, None)
+        if future is None:
+            return None
+        return future.result()
+
     def open_header(self, include_header, skip_file, anchor_file):
+        anchor_directory = self._anchor_directory(anchor_file)
+        key = (anchor_directory, include_header, anchor_file is not None)
+        prefetched = self._take_prefetched(key)
         header_path = self.resolved.get(include_header)
-        f = None
         if header_path is not None:
             if skip_file(header_path):
                 return SKIP_FILE
             else:
-                return self._open(header_path)
-        for include_path in self._resolve(anchor_file):
-            header_path = posixpath.join(include_path, include_header)
-            f = self._open(posixpath.normpath(header_path))
+                return prefetched or self._open(header_path)
+        try:
+            header_path = self.resolution_cache[key]
+        except KeyError:
+            pass
+        else:
+            if header_path is None:
+                return None
+            if skip_file(header_path):
+                return SKIP_FILE
+            f = prefetched or self._open(header_path)
             if f:
-                self.resolved[include_header] = f.name
+                return f
+            # File went away since it was resolved
+            self.invalidate(include_header)
+        if prefetched:
+            self.resolution_cache[key] = prefetched.name
+            if skip_file(prefetched.name):
+                return SKIP_FILE
+            return prefetched
+        header_path, f = self._search(include_header, anchor_directory,
+                                      skip_file)
+        self.resolution_cache[key] = header_path
+        return f
+
+
+class DirectoryIndex(object):
+    """
+    Index of directory listings, scanned lazily one directory at a time.
+    Paths are posix style relative or absolute paths. Unless
+    case_sensitive, paths and names are compared in lower case.
+    """
+
+    def __init__(self, listings=None, case_sensitive=CASE_SENSITIVE):
+        self.case_sensitive = case_sensitive
+        # directory -> (file names, subdirectory names)
+        self.listings = {}
+        fold = self._fold
+        for directory, (files, dirs) in (listings or {}).items():
+            self.listings[fold(directory)] = (
+                frozenset(map(fold, files)), frozenset(map(fold, dirs))
+            )
+
+    def _fold(self, name):
+        return name if self.case_sensitive else name.lower()
+
+    def _listing(self, directory):
+        try:
+            return self.listings[directory]
+        except KeyError:
+            pass
+        files = set()
+        dirs = set()
+        try:
+            with os.scandir(directory or ".") as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        dirs.add(self._fold(entry.name))
+                    elif entry.is_file():
+                        files.add(self._fold(entry.name))
+        except OSError:
+            pass
+        listing = self.listings[directory] = frozenset(files), frozenset(dirs)
+        return listing
+
+    def _is_dir(self, directory):
+        parent, name = posixpath.split(directory)
+        if name in ("", ".", ".."):
+            return True
+        if parent and not self._is_dir(parent):
+            return False
+        return name in self._listing(parent)[1]
+
+    def is_dir(self, directory):
+        return self._is_dir(self._fold(directory))
+
+    def exists(self, path):
+        directory, name = posixpath.split(self._fold(path))
+        if directory and not self._is_dir(directory):
+            return False
+        return name in self._listing(directory)[0]
+
+    def forget(self, path):
+        """Drop the listings that a lookup of path is answered from."""
+        directory = posixpath.dirname(self._fold(path))
+        while True:
+            self.listings.pop(directory, None)
+            parent = posixpath.dirname(directory)
+            if parent == directory:
                 break
+            directory = parent
+
+    def clear(self):
+        self.listings.clear()
+
+    def save(self, path):
+        listings = {
+            directory: [sorted(files), sorted(dirs)]
+            for directory, (files, dirs) in self.listings.items()
+        }
+        with open(path, "w") as f:
+            json.dump(listings, f, sort_keys=True)
+
+    @classmethod
+    def load(cls, path, case_sensitive=CASE_SENSITIVE):
+        with open(path) as f:
+            return cls(json.load(f), case_sensitive)
+
+
+class IndexedHeaderHandler(HeaderHandler):
+    """
+    Header handler that consults a DirectoryIndex before opening files so
+    that include path probes for missing headers need no system calls.
+    The index can be saved and loaded for read-only trees such as SDKs.
+    """
+
+    def __init__(self, include_paths, index=None, content_cache=None,
+                 token_cache=None, executor=None, binary=False):
+        super(IndexedHeaderHandler, self).__init__(include_paths,
+                                                   content_cache,
+                                                   token_cache,
+                                                   executor,
+                                                   binary)
+        self.index = DirectoryIndex() if index is None else index
+
+    def _exists(self, header_path):
+        return self.index.exists(header_path)
+
+    def _open(self, header_path):
+        if not self.index.exists(header_path):
+            return None
+        return super(IndexedHeaderHandler, self)._open(header_path)
+
+    def invalidate(self, include_header=None):
+        """
+        Like HeaderHandler.invalidate(), also rescanning the directories
+        where include_header was looked up, or every directory.
+        """
+        if include_header is None:
+            self.index.clear()
+        else:
+            directories = set(self.include_paths)
+            for key in self.resolution_cache:
+                if key[1] == include_header and key[0] is not None:
+                    directories.add(key[0])
+            for directory in directories:
+                self.index.forget(posixpath.normpath(
+                    posixpath.join(directory, include_header)
+                ))
+        super(IndexedHeaderHandler, self).invalidate(include_header)
+
+
+class ArchiveHandler(HeaderHandler):
+    """
+    Header handler that serves headers from a zip file or an uncompressed
+    tar file without extracting it. The archive acts as the file system:
+    include paths and header names are posix paths of archive members.
+    """
+
+    def __init__(self, archive_path, include_paths=(), token_cache=None,
+                 executor=None, binary=False):
+        super(ArchiveHandler, self).__init__(include_paths,
+                                             token_cache=token_cache,
+                                             executor=executor,
+                                             binary=binary)
+        self.archive_path = archive_path
+        self.lock = threading.Lock()
+        # Member path -> zip info or (data offset, size) in the tar file
+        self.members = {}
+        if zipfile.is_zipfile(archive_path):
+            self.archive = zipfile.ZipFile(archive_path)
+            for info in self.archive.infolist():
+                if not info.is_dir():
+                    self.members[posixpath.normpath(info.filename)] = info
+        else:
+            with tarfile.open(archive_path, "r:") as tar:
+                for info in tar:
+                    if info.isfile():
+                        name = posixpath.normpath(info.name)
+                        self.members[name] = info.offset_data, info.size
+            self.archive = open(archive_path, "rb")
+
+    def _read_member(self, member):
+        if isinstance(member, zipfile.ZipInfo):
+            # ZipFile supports concurrent reads of members
+            return self.archive.read(member)
+        offset, size = member
+        with self.lock:
+            self.archive.seek(offset)
+            return self.archive.read(size)
+
+    def _exists(self, header_path):
+        return posixpath.normpath(header_path) in self.members
+
+    def _open(self, header_path):
+        member = self.members.get(posixpath.normpath(header_path))
+        if member is None:
+            return None
+        text = self._read_member(member).decode(self.encoding or "utf-8")
+        return MemoryFile(header_path, text)
+
+    def file_identity(self, name):
+        return self.archive_path, posixpath.normpath(name)
+
+    def close(self):
+        super(ArchiveHandler, self).close()
+        self.archive.close()
+
+
+class MemoryHandler(HeaderHandler):
+    """
+    Header handler serving headers held in memory as str, bytes or
+    memoryview buffers, overlaid on the real file system. Buffers are
+    decoded once when added, as UTF-8 or as BINARY_ENCODING in binary
+    mode, and opened as shared read-only MemoryFile objects.
+    """
+
+    def __init__(self, headers=(), include_paths=(), content_cache=None,
+                 token_cache=None, executor=None, binary=False):
+        super(MemoryHandler, self).__init__(include_paths, content_cache,
+                                            token_cache, executor, binary)
+        self.buffers = {}
+        for header_path, data in dict(headers).items():
+            self.add(header_path, data)
+
+    def add(self, header_path, data):
+        """Add or replace the in-memory header at header_path."""
+        if not isinstance(data, str):
+            data = str(data, self.encoding or "utf-8")
+        header_path = posixpath.normpath(header_path)
+        self.buffers[header_path] = MemoryFile(header_path, data)
+        self.invalidate()
+
+    def _open(self, header_path):
+        f = self.buffers.get(posixpath.normpath(header_path))
+        if f is None:
+            return super(MemoryHandler, self)._open(header_path)
+        if f.name != header_path:
+            f = MemoryFile(header_path, f.text)
         return f
 
+    def file_identity(self, name):
+        normalized = posixpath.normpath(name)
+        if normalized in self.buffers:
+            return "<memory>", normalized
+        return super(MemoryHandler, self).file_identity(name)
+
 
 class FakeFile(object):
 
@@ -66,9 +701,13 @@ class FakeFile(object):
 
 class FakeHandler(HeaderHandler):
 
-    def __init__(self, header_mapping, include_paths=()):
+    def __init__(self, header_mapping, include_paths=(), token_cache=None):
         self.header_mapping = header_mapping
-        super(FakeHandler, self).__init__(list(include_paths))
+        super(FakeHandler, self).__init__(list(include_paths),
+                                          token_cache=token_cache)
+
+    def file_identity(self, name):
+        return posixpath.normpath(name)
 
     def _open(self, header_path):
         contents = self.header_mapping.get(header_path)
@@ -0,0 +1,131 @@
+"""
+Persistent database of include guards for the multiple-include optimization.
+
+Records which headers are protected by #pragma once or by a full-file
+#ifdef/#ifndef guard so that later runs can skip re-included headers
+without reading them. Entries are validated against the file modification
+time and size, falling back to a content hash when only the time differs.
+"""
+import json
+import os
+import threading
+
+from .core import Tag
+from .filesystem import BINARY_ENCODING, stat_identity, text_digest
+
+
+def _file_hash(path, binary=False):
+    # Read the way the preprocessor reads headers so that digests match
+    if binary:
+        f = open(path, encoding=BINARY_ENCODING, newline="\n")
+    else:
+        f = open(path, errors="surrogateescape")
+    with f:
+        return text_digest(f.read())
+
+
+def _identity_key(identity):
+    if isinstance(identity, str):
+        return identity
+    return ":".join(str(part) for part in identity)
+
+
+class GuardDatabase(object):
+    """
+    Maps file identities of headers to their guard. A guard is either
+    Tag.PRAGMA_ONCE or a (macro, Tag.IFDEF/Tag.IFNDEF) pair as stored in
+    Preprocessor.include_once. The database can be shared between
+    Preprocessor instances and saved to disk between runs.
+
+    identity is the file identity of the header handler, by default that
+    of filesystem.HeaderHandler, so that every path reaching the same
+    file shares one entry.
+    """
+
+    def __init__(self):
+        # identity -> (mtime_ns, size, sha1, guard)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.identities = {}
+
+    def _key(self, name, identity):
+        if identity is not None:
+            # Remembered so that lookups without identity find the entry
+            self.identities[name] = identity
+        else:
+            try:
+                identity = self.identities[name]
+            except KeyError:
+                identity = self.identities[name] = stat_identity(name)
+        return _identity_key(identity)
+
+    def record(self, name, guard, identity=None, digest=None,
+               binary=False):
+        """
+        Record the guard of file name. digest is the text_digest of the
+        text the preprocessor read, the file is hashed if it is not given.
+        binary tells whether the file was read in binary mode.
+        """
+        key = self._key(name, identity)
+        try:
+            st = os.stat(name)
+            if digest is None:
+                digest = _file_hash(name, binary)
+        except IOError:
+            return
+        with self.lock:
+            self.entries[key] = st.st_mtime_ns, st.st_size, digest, guard
+
+    def lookup(self, name, identity=None, binary=False):
+        """
+        Return the guard of the file, or None if unknown or stale. binary
+        tells whether the file is read in binary mode.
+        """
+        key = self._key(name, identity)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        mtime_ns, size, digest, guard = entry
+        try:
+            st = os.stat(name)
+            if st.st_size != size:
+                valid = False
+            elif st.st_mtime_ns == mtime_ns:
+                valid = True
+            else:
+                # Touched but possibly unchanged, eg after a checkout
+                valid = _file_hash(name, binary) == digest
+        except IOError:
+            valid = False
+        with self.lock:
+            if valid:
+                self.entries[key] = st.st_mtime_ns, size, digest, guard
+            else:
+                self.entries.pop(key, None)
+        return guard if valid else None
+
+    def save(self, path):
+        with self.lock:
+            entries = dict(self.entries)
+        data = {}
+        for key, (mtime_ns, size, digest, guard) in entries.items():
+            if guard is Tag.PRAGMA_ONCE:
+                guard = [guard.value]
+            else:
+                guard = [guard[1].value, guard[0]]
+            data[key] = [mtime_ns, size, digest, guard]
+        with open(path, "w") as f:
+            json.dump(data, f, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        database = cls()
+        with open(path) as f:
+            data = json.load(f)
+        for key, (mtime_ns, size, digest, guard) in data.items():
+            tag = Tag(guard[0])
+            if tag is not Tag.PRAGMA_ONCE:
+                tag = guard[1], tag
+            database.entries[key] = mtime_ns, size, digest, tag
+        return database
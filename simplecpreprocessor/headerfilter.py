@@ -0,0 +1,89 @@
+"""
+Matching of include names against ignore_headers patterns.
+
+Patterns are exact header names, globs (`*` and `?` stay within one path
+component, `**` crosses directories, `[...]` is a character class) or
+regular expressions prefixed with `re:`. Globs are compiled into one
+regular expression and each `re:` pattern on its own, so that their
+groups and inline flags keep their meaning. The matchers are consulted
+before any path resolution or I/O.
+"""
+import re
+
+GLOB_CHARACTERS = frozenset("*?[")
+REGEX_PREFIX = "re:"
+
+
+def glob_to_regex(pattern):
+    """Translate a header glob into an equivalent regular expression."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            members = pattern[i + 1:end].replace("\\", "\\\\")
+            if members.startswith("!"):
+                members = "^" + members[1:]
+            parts.append("[%s]" % members)
+            i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "".join(parts)
+
+
+class HeaderFilter(object):
+    """
+    Compiled set of header patterns. `header in header_filter` tells if
+    the include name matches any pattern. Instances are immutable and can
+    be shared between preprocessors and runs.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = tuple(patterns)
+        exact = set()
+        globs = []
+        regexes = []
+        for pattern in self.patterns:
+            if pattern.startswith(REGEX_PREFIX):
+                regexes.append(re.compile(pattern[len(REGEX_PREFIX):]))
+            elif GLOB_CHARACTERS.intersection(pattern):
+                globs.append(glob_to_regex(pattern))
+            else:
+                exact.add(pattern)
+        self.exact = frozenset(exact)
+        if globs:
+            # Translated globs have no groups or flags and can be joined
+            self.regex = re.compile(
+                "|".join("(?:%s)" % regex for regex in globs)
+            )
+        else:
+            self.regex = None
+        self.regexes = tuple(regexes)
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        """Return patterns as a HeaderFilter, compiling them if needed."""
+        if isinstance(patterns, cls):
+            return patterns
+        return cls(patterns)
+
+    def __contains__(self, header):
+        if header in self.exact:
+            return True
+        if self.regex is not None and self.regex.fullmatch(header):
+            return True
+        return any(regex.fullmatch(header) for regex in self.regexes)
@@ -0,0 +1,286 @@
+"""
+Single-pass preprocessing of one source under several define configurations.
+
+Each configuration is identified by its index and every conditional block
+carries a bitmask of the configurations for which it is active, so that
+tokenization and include resolution happen once for all of them.
+"""
+from . import exceptions, expression, filesystem, platform, tokens
+from .core import (
+    ConditionFrame, Defines, Preprocessor, Tag, TOKEN_CONSTANTS,
+    constants_to_token_constants,
+)
+
+
+def iter_configurations(mask):
+    """Yield the configuration indexes set in mask."""
+    index = 0
+    while mask:
+        if mask & 1:
+            yield index
+        mask >>= 1
+        index += 1
+
+
+def _first_name(chunk):
+    for token in chunk:
+        if not token.whitespace:
+            return token.value
+    return None  # pragma: no cover
+
+
+class MaskFrame(ConditionFrame):
+    """Conditional block that is active for a bitmask of configurations."""
+
+    def __init__(self, tag, condition, line_no, parent_mask):
+        super().__init__(tag, condition, line_no)
+        self.parent_mask = parent_mask
+        self.active_mask = 0
+        self.taken_mask = 0
+
+    def select(self, mask):
+        """Activate the branch for configurations in mask not yet taken."""
+        mask &= self.parent_mask & ~self.taken_mask
+        self.active_mask = mask
+        self.taken_mask |= mask
+        self.currently_active = bool(mask)
+        self.branch_taken = self.taken_mask == self.parent_mask
+
+
+class MultiConfigPreprocessor(Preprocessor):
+    """
+    Preprocessor that evaluates several configurations in one pass.
+
+    preprocess() yields (mask, text) pairs where mask tells which
+    configurations the text belongs to.
+    """
+
+    def __init__(self, configurations, line_ending=tokens.DEFAULT_LINE_ENDING,
+                 include_paths=(), header_handler=None,
+                 platform_constants=TOKEN_CONSTANTS,
+                 ignore_headers=(), fold_strings_to_null=False,
+                 int_bits=None):
+        super().__init__(line_ending, include_paths, header_handler,
+                         platform_constants, ignore_headers,
+                         fold_strings_to_null, int_bits)
+        # Macro use is decided per configuration from the tokens
+        self.verbatim = False
+        self.configurations = []
+        for configuration in configurations:
+            defines = Defines(platform_constants)
+            for key, value in configuration.items():
+                defines[key] = value
+            self.configurations.append(defines)
+        self.all_mask = (1 << len(self.configurations)) - 1
+        self.expanders = [
+            tokens.TokenExpander(defines) for defines in self.configurations
+        ]
+        self.defined_masks = {}
+        for index, defines in enumerate(self.configurations):
+            for key in defines.defines:
+                self.defined_masks[key] = (
+                    self.defined_masks.get(key, 0) | 1 << index
+                )
+        self.once_masks = {}
+        self.file_masks = []
+
+    def active_mask(self):
+        """Bitmask of configurations for which current content is active."""
+        mask = self.file_masks[-1] if self.file_masks else self.all_mask
+        if self.condition_stack:
+            mask &= self.condition_stack[-1].active_mask
+        return mask
+
+    def _should_ignore(self):
+        return not self.active_mask()
+
+    def _push_frame(self, tag, condition, line_no):
+        frame = MaskFrame(tag, condition, line_no, self.active_mask())
+        self.condition_stack.append(frame)
+        return frame
+
+    def _evaluate(self, chunk, mask, directive, line_no):
+        """Return mask of configurations in mask for which chunk is true."""
+        result = 0
+        for index in iter_configurations(mask):
+            try:
+                value = expression.evaluate_expression(
+                    chunk, self.configurations[index], self.int_bits
+                )
+            except (SyntaxError, ZeroDivisionError) as e:
+                fmt = "Error evaluating %s on line %s: %s"
+                raise exceptions.ParseError(fmt % (directive, line_no, e))
+            if value:
+                result |= 1 << index
+        return result
+
+    def process_define(self, **kwargs):
+        mask = self.active_mask()
+        define_name, value = self._parse_define(kwargs["chunk"])
+        if define_name is None:  # pragma: no cover
+            return
+        for index in iter_configurations(mask):
+            self.configurations[index][define_name] = value
+        self.defined_masks[define_name] = (
+            self.defined_masks.get(define_name, 0) | mask
+        )
+
+    def process_undef(self, **kwargs):
+        mask = self.active_mask()
+        undefine = _first_name(kwargs["chunk"])
+        for index in iter_configurations(mask):
+            del self.configurations[index][undefine]
+        self.defined_masks[undefine] = (
+            self.defined_masks.get(undefine, 0) & ~mask
+        )
+
+    def process_ifdef(self, **kwargs):
+        condition = _first_name(kwargs["chunk"])
+        frame = self._push_frame(Tag.IFDEF, condition, kwargs["line_no"])
+        frame.select(self.defined_masks.get(condition, 0))
+
+    def process_ifndef(self, **kwargs):
+        condition = _first_name(kwargs["chunk"])
+        frame = self._push_frame(Tag.IFNDEF, condition, kwargs["line_no"])
+        frame.select(~self.defined_masks.get(condition, 0))
+
+    def process_if(self, **kwargs):
+        chunk = kwargs["chunk"]
+        line_no = kwargs["line_no"]
+        mask = self.active_mask()
+        result = self._evaluate(chunk, mask, "#if", line_no)
+        frame = self._push_frame(Tag.IF, result, line_no)
+        frame.select(result)
+
+    def process_elif(self, **kwargs):
+        chunk = kwargs["chunk"]
+        line_no = kwargs["line_no"]
+        if not self.condition_stack:
+            fmt = "Unexpected #elif on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame = self.condition_stack[-1]
+        if frame.tag == Tag.ELSE:
+            fmt = "#elif after #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        pending = frame.parent_mask & ~frame.taken_mask
+        frame.select(self._evaluate(chunk, pending, "#elif", line_no))
+        frame.tag = Tag.ELIF
+
+    def process_else(self, **kwargs):
+        line_no = kwargs["line_no"]
+        if not self.condition_stack:
+            fmt = "Unexpected #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame = self.condition_stack[-1]
+        if frame.tag == Tag.ELSE:
+            fmt = "#else after #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame.select(self.all_mask)
+        frame.tag = Tag.ELSE
+
+    def process_pragma_once(self, **_):
+        identity = self.headers.file_identity(self.current_name())
+        self.once_masks[identity] = (
+            self.once_masks.get(identity, 0) | self.active_mask()
+        )
+
+    def process_pragma_pack(self, chunk, **_):
+        text = "#pragma" + "".join(token.value for token in chunk)
+        yield self.active_mask(), text
+
+    def skip_mask(self, name):
+        """Bitmask of configurations for which the file should be skipped."""
+        identity = self.headers.file_identity(name)
+        mask = self.once_masks.get(identity, 0)
+        item = self.include_once.get(identity)
+        if item is not None:
+            constraint, constraint_type = item
+            defined = self.defined_masks.get(constraint, 0)
+            if constraint_type is Tag.IFDEF:
+                mask |= ~defined
+            else:
+                assert constraint_type is Tag.IFNDEF
+                mask |= defined
+        return mask & self.all_mask
+
+    def skip_file(self, name):
+        mask = self.active_mask()
+        return self.skip_mask(name) & mask == mask
+
+    def _read_header(self, header, error, anchor_file=None):
+        if header in self.ignore_headers:
+            return
+        f = self.headers.open_header(header, self.skip_file, anchor_file)
+        if f is None:
+            raise error
+        elif f is not filesystem.SKIP_FILE:
+            # Handler only returns files some active configuration needs
+            mask = self.active_mask() & ~self.skip_mask(f.name)
+            self.push_file(f)
+            self.file_masks.append(mask)
+
+    def pop_file(self):
+        frame = super().pop_file()
+        if frame.closing:
+            self.file_masks.pop()
+        return frame
+
+    def process_source_chunks(self, chunk):
+        mask = self.active_mask()
+        if not mask:
+            return
+        defined_masks = self.defined_masks
+        for token in chunk:
+            if defined_masks.get(token.value, 0) & mask:
+                break
+        else:
+            # No macro is defined in any active configuration
+            yield mask, "".join(self.emit(chunk))
+            return
+        outputs = {}
+        for index in iter_configurations(mask):
+            expanded = self.expanders[index].expand_tokens(chunk)
+            text = "".join(self.emit(expanded))
+            outputs[text] = outputs.get(text, 0) | 1 << index
+        for text, text_mask in outputs.items():
+            yield text_mask, text
+
+
+def split_streams(pairs, count):
+    """Split (mask, text) pairs into one output string per configuration."""
+    outputs = [[] for _ in range(count)]
+    for mask, text in pairs:
+        for index in iter_configurations(mask):
+            outputs[index].append(text)
+    return ["".join(output) for output in outputs]
+
+
+def preprocess_configurations(f_object, configurations, line_ending="\n",
+                              include_paths=(), header_handler=None,
+                              extra_constants=(), ignore_headers=(),
+                              fold_strings_to_null=False, int_bits=None):
+    """
+    Preprocess f_object once for all configurations.
+
+    configurations is a sequence of {name: value} mappings of extra defines.
+    Returns a list with the preprocessed text of each configuration.
+    """
+    platform_constants = platform.PLATFORM_CONSTANTS.copy()
+    platform_constants.update(extra_constants)
+    configurations = [
+        constants_to_token_constants(configuration)
+        for configuration in configurations
+    ]
+    preprocessor = MultiConfigPreprocessor(
+        configurations,
+        line_ending,
+        include_paths,
+        header_handler,
+        constants_to_token_constants(platform_constants),
+        ignore_headers,
+        fold_strings_to_null,
+        int_bits
+    )
+    return split_streams(
+        preprocessor.preprocess(f_object), len(configurations)
+    )
@@ -0,0 +1,260 @@
+"""
+Partial evaluation (unifdef-style) of headers against a set of known macros.
+
+Conditionals that only depend on known macros are resolved and their
+directives removed. Everything else, including conditionals on unknown
+macros, #define, #undef, #include and #pragma lines and the source text
+itself, is written out without expansion so that a later full
+preprocessing run produces the same result as it would for the original.
+"""
+from . import exceptions, expression, tokens
+from .core import (
+    ConditionFrame, Defines, Preprocessor, Tag, constants_to_token_constants,
+)
+
+
+class UnknownMacro(Exception):
+    pass
+
+
+class KnownDefines(Defines):
+    """Defines that refuse to answer for macros outside the known set."""
+
+    def __init__(self, base, undefined):
+        super().__init__(base)
+        self.undefined = set(undefined)
+
+    def __contains__(self, key):
+        if key in self.defines:
+            return True
+        if key in self.undefined:
+            return False
+        raise UnknownMacro(key)
+
+    def is_known(self, key):
+        return key in self.defines or key in self.undefined
+
+    def forget(self, key):
+        """Make key unknown."""
+        self.defines.pop(key, None)
+        self.undefined.discard(key)
+
+
+class PartialFrame(ConditionFrame):
+    """Conditional block whose branches may be resolved or kept."""
+
+    def __init__(self, tag, condition, line_no, dropped):
+        super().__init__(tag, condition, line_no)
+        # Whole group is inside a removed branch
+        self.dropped = dropped
+        # Some directive of the group has been written out
+        self.emitted = False
+
+
+def _first_name(chunk):
+    for token in chunk:
+        if not token.whitespace:
+            return token.value
+    return None  # pragma: no cover
+
+
+class PartialPreprocessor(Preprocessor):
+    """
+    Preprocessor that resolves only conditionals on known macros.
+
+    known_defines maps macro names to their token values, known_undefines
+    lists macros that are known not to be defined.
+    """
+
+    def __init__(self, known_defines, known_undefines=(),
+                 line_ending=tokens.DEFAULT_LINE_ENDING, int_bits=None):
+        super().__init__(line_ending, platform_constants={},
+                         int_bits=int_bits)
+        self.defines = KnownDefines(known_defines, known_undefines)
+
+    def _directive(self, name, chunk):
+        return "#" + name + "".join(token.value for token in chunk)
+
+    def _known_value(self, directive, chunk, line_no):
+        """Evaluate chunk, returning None if it depends on unknown macros."""
+        previous = None
+        for token in chunk:
+            value = token.value
+            if token.whitespace or value == "(":
+                continue
+            # Macros used as values are only known when undefined
+            if (
+                previous != "defined"
+                and value != "defined"
+                and (value[0].isalpha() or value[0] == "_")
+                and value not in self.defines.undefined
+            ):
+                return None
+            previous = value
+        try:
+            return expression.evaluate_expression(
+                chunk, self.defines, self.int_bits
+            ) != 0
+        except UnknownMacro:
+            return None
+        except (SyntaxError, ZeroDivisionError) as e:
+            fmt = "Error evaluating %s on line %s: %s"
+            raise exceptions.ParseError(fmt % (directive, line_no, e))
+
+    def _known_defined(self, chunk):
+        try:
+            return _first_name(chunk) in self.defines
+        except UnknownMacro:
+            return None
+
+    def _open_group(self, tag, condition, line_no, known, text):
+        frame = PartialFrame(tag, condition, line_no, self._should_ignore())
+        self.condition_stack.append(frame)
+        if frame.dropped:
+            frame.branch_taken = True
+        elif known is None:
+            frame.currently_active = True
+            frame.emitted = True
+            yield text
+        elif known:
+            frame.currently_active = True
+            frame.branch_taken = True
+
+    def process_ifdef(self, **kwargs):
+        chunk = kwargs["chunk"]
+        return self._open_group(
+            Tag.IFDEF, _first_name(chunk), kwargs["line_no"],
+            self._known_defined(chunk), self._directive("ifdef", chunk)
+        )
+
+    def process_ifndef(self, **kwargs):
+        chunk = kwargs["chunk"]
+        known = self._known_defined(chunk)
+        return self._open_group(
+            Tag.IFNDEF, _first_name(chunk), kwargs["line_no"],
+            None if known is None else not known,
+            self._directive("ifndef", chunk)
+        )
+
+    def process_if(self, **kwargs):
+        chunk = kwargs["chunk"]
+        line_no = kwargs["line_no"]
+        known = None
+        if not self._should_ignore():
+            known = self._known_value("#if", chunk, line_no)
+        return self._open_group(
+            Tag.IF, known, line_no, known, self._directive("if", chunk)
+        )
+
+    def process_elif(self, **kwargs):
+        chunk = kwargs["chunk"]
+        line_no = kwargs["line_no"]
+        if not self.condition_stack:
+            fmt = "Unexpected #elif on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame = self.condition_stack[-1]
+        if frame.tag == Tag.ELSE:
+            fmt = "#elif after #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame.tag = Tag.ELIF
+        frame.currently_active = False
+        if frame.branch_taken:
+            return
+        known = self._known_value("#elif", chunk, line_no)
+        if known is None:
+            frame.currently_active = True
+            # Earlier branches were all removed as false
+            name = "elif" if frame.emitted else "if"
+            frame.emitted = True
+            yield self._directive(name, chunk)
+        elif known:
+            frame.currently_active = True
+            frame.branch_taken = True
+            if frame.emitted:
+                yield "#else" + self.line_ending
+
+    def process_else(self, **kwargs):
+        chunk = kwargs["chunk"]
+        line_no = kwargs["line_no"]
+        if not self.condition_stack:
+            fmt = "Unexpected #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame = self.condition_stack[-1]
+        if frame.tag == Tag.ELSE:
+            fmt = "#else after #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        frame.tag = Tag.ELSE
+        frame.currently_active = not frame.branch_taken
+        frame.branch_taken = True
+        if frame.currently_active and frame.emitted:
+            yield self._directive("else", chunk)
+
+    def process_endif(self, **kwargs):
+        chunk = kwargs["chunk"]
+        if self.condition_stack:
+            frame = self.condition_stack[-1]
+            if frame.emitted:
+                yield self._directive("endif", chunk)
+        super().process_endif(**kwargs)
+
+    def _passthrough(self, name, chunk):
+        yield self._directive(name, chunk)
+
+    def _track(self, name, value):
+        """
+        Update what is known of name after the file defines it to value,
+        or undefines it if value is None. Unknown macros stay unknown.
+        """
+        defines = self.defines
+        if not defines.is_known(name):
+            return
+        if any(frame.emitted for frame in self.condition_stack):
+            # Inside a kept conditional, so the directive may not run
+            defines.forget(name)
+        elif value is None:
+            del defines[name]
+            defines.undefined.add(name)
+        else:
+            defines[name] = value
+            defines.undefined.discard(name)
+
+    def process_define(self, **kwargs):
+        chunk = kwargs["chunk"]
+        self._track(*self._parse_define(chunk))
+        return self._passthrough("define", chunk)
+
+    def process_undef(self, **kwargs):
+        chunk = kwargs["chunk"]
+        self._track(_first_name(chunk), None)
+        return self._passthrough("undef", chunk)
+
+    def process_include(self, **kwargs):
+        return self._passthrough("include", kwargs["chunk"])
+
+    def process_pragma(self, **kwargs):
+        return self._passthrough("pragma", kwargs["chunk"])
+
+    def unsupported_directive(self, name, line_no, chunk):
+        return self._passthrough(name, chunk)
+
+    def process_source_chunks(self, chunk):
+        if not self._should_ignore():
+            for token in chunk:
+                yield token.value
+
+
+def preprocess_partial(f_object, defines=(), undefines=(), line_ending="\n",
+                       int_bits=None):
+    """
+    Resolve conditionals that only depend on the given known macros.
+
+    defines maps known macro names to their values and undefines lists
+    macros known to be undefined. Yields text chunks of the reduced source.
+    """
+    preprocessor = PartialPreprocessor(
+        constants_to_token_constants(dict(defines)),
+        undefines,
+        line_ending,
+        int_bits
+    )
+    return preprocessor.preprocess(f_object)
@@ -0,0 +1,82 @@
+"""
+Mapping of preprocessed output lines back to their original source lines.
+
+The origin of every output line is kept in two parallel arrays of file
+ids and line numbers with a table of file names, so that large outputs
+need no per-line or per-token objects. Line numbers are one based as in
+compiler diagnostics.
+"""
+import array
+import struct
+import sys
+
+MAGIC = b"SCPPMAP1"
+HEADER = struct.Struct("<II")
+LENGTH = struct.Struct("<I")
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":  # pragma: no cover
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class SourceMap(object):
+    """Origin (file, line) of each output line."""
+
+    def __init__(self):
+        self.files = []
+        self.file_ids = {}
+        self.file_column = array.array("I")
+        self.lines = array.array("I")
+
+    def file_id(self, name):
+        """Return the id of file name in the file table, adding it if new."""
+        try:
+            return self.file_ids[name]
+        except KeyError:
+            file_id = self.file_ids[name] = len(self.files)
+            self.files.append(name)
+            return file_id
+
+    def add(self, file_id, line):
+        """Record the origin of the next output line."""
+        self.file_column.append(file_id)
+        self.lines.append(line)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def lookup(self, output_line):
+        """Return (file name, line) for a one based output line number."""
+        index = output_line - 1
+        return self.files[self.file_column[index]], self.lines[index]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(len(self.files), len(self.lines)))
+            for name in self.files:
+                data = name.encode("utf-8")
+                f.write(LENGTH.pack(len(data)))
+                f.write(data)
+            f.write(_little_endian(self.file_column).tobytes())
+            f.write(_little_endian(self.lines).tobytes())
+
+    @classmethod
+    def load(cls, path):
+        source_map = cls()
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a source map" % path)
+            file_count, line_count = HEADER.unpack(f.read(HEADER.size))
+            for _ in range(file_count):
+                length, = LENGTH.unpack(f.read(LENGTH.size))
+                source_map.file_id(f.read(length).decode("utf-8"))
+            itemsize = source_map.lines.itemsize
+            source_map.file_column.frombytes(f.read(line_count * itemsize))
+            source_map.lines.frombytes(f.read(line_count * itemsize))
+        source_map.file_column = _little_endian(source_map.file_column)
+        source_map.lines = _little_endian(source_map.lines)
+        return source_map
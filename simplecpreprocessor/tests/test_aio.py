@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import mock
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.aio import ThreadedHeaderHandler, preprocess_async
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+
+
+def collect(f_obj, **kwargs):
+    async def run():
+        return [chunk async for chunk in preprocess_async(f_obj, **kwargs)]
+    return asyncio.run(run())
+
+
+def make_headers():
+    return {
+        "a.h": ["#pragma once\n", '#include "b.h"\n', "#define X 1\n",
+                "a X\n"],
+        "b.h": ["#ifndef B\n", "#define B\n", "b\n", "#endif\n"],
+        "ignored.h": ["ignored\n"],
+    }
+
+
+def make_main():
+    return FakeFile("main.c", ['#include "a.h"\n', "#include <a.h>\n",
+                               '#include "b.h"\n', "#include <ignored.h>\n",
+                               "main X\n"])
+
+
+class ThreadRecordingHandler(FakeHandler):
+
+    def __init__(self, header_mapping, include_paths=()):
+        super(ThreadRecordingHandler, self).__init__(header_mapping,
+                                                     include_paths)
+        self.threads = set()
+
+    def _open(self, header_path):
+        self.threads.add(threading.current_thread())
+        return super(ThreadRecordingHandler, self)._open(header_path)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"line_output": True},
+                                    {"compact": True}])
+def test_preprocess_async(kwargs):
+    expected = list(preprocess(make_main(), include_paths=["."],
+                               header_handler=FakeHandler(make_headers()),
+                               ignore_headers=["ignored.h"], **kwargs))
+    handler = ThreadRecordingHandler(make_headers())
+    with ThreadPoolExecutor(1) as executor:
+        ret = collect(make_main(), include_paths=["."],
+                      header_handler=ThreadedHeaderHandler(handler, executor),
+                      ignore_headers=["ignored.h"], **kwargs)
+    assert ret == expected
+    assert "".join(ret).split() == ["b", "a", "1", "main", "1"]
+    assert threading.main_thread() not in handler.threads
+
+
+def test_preprocess_async_default_handler(tmp_path):
+    (tmp_path / "a.h").write_text("#pragma once\na\n")
+    f_obj = FakeFile("main.c", ["#include <a.h>\n", "#include <a.h>\n"])
+    assert collect(f_obj, include_paths=[tmp_path.as_posix()]) == ["a\n"]
+
+
+def test_preprocess_async_missing_header():
+    f_obj = FakeFile("main.c", ['#include "a.h"\n'])
+    handler = FakeHandler({"a.h": ['#include "missing.h"\n']})
+    with pytest.raises(ParseError) as excinfo:
+        collect(f_obj, header_handler=ThreadedHeaderHandler(handler))
+    assert "missing.h" in str(excinfo.value)
+
+
+def test_preprocess_async_yield_interval():
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    f_obj = FakeFile("main.c", ["a b c\n", "d e\n"])
+    with mock.patch("simplecpreprocessor.aio.asyncio.sleep", sleep):
+        ret = collect(f_obj, line_output=True, yield_interval=1)
+    assert ret == ["a b c\n", "d e\n"]
+    assert sleeps == [0, 0]
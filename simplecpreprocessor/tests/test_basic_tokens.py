@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 from simplecpreprocessor import preprocess
+from simplecpreprocessor.core import Preprocessor
 from simplecpreprocessor.filesystem import FakeFile
+from simplecpreprocessor.sourcemap import SourceMap
+from simplecpreprocessor.tokens import Tokenizer, TokenType
 
 
 def run_case(input_list, expected):
@@ -90,3 +93,82 @@ def test_empty_lines():
     ])
     expected = "\n\n1\n"
     run_case(f_obj, expected)
+
+
+VERBATIM_CASES = [
+    "int a;\n",
+    "int b;\r\n",
+    "\tchar\t*p = \"#x\";  \n",
+    "\n",
+    "   \n",
+    "x = a / b;\n",
+    "stray */ end\n",
+    "#define A 1\n",
+    "int c = A;\n",
+    "#undef A\n",
+    "int d = A;\n",
+    "int e = 1; /* start\n",
+    "inside comment\n",
+    "end */ int f;\n",
+    "// comment \\\n",
+    "continued comment\n",
+    "int g \\\n",
+    "  = 2;\n",
+    "#if 0\n",
+    "dead\n",
+    "#endif\n",
+    "#define B 2\n",
+    "B b\r\r\n",
+    "last",
+]
+
+
+def test_verbatim_lines_match_tokenized_output():
+    f_obj = FakeFile("header.h", VERBATIM_CASES)
+    for line_ending in ("\n", "\r\n", "\r", ""):
+        preprocessor = Preprocessor(line_ending)
+        fast = "".join(preprocessor.preprocess(f_obj))
+        preprocessor = Preprocessor(line_ending)
+        preprocessor.verbatim = False
+        slow = "".join(preprocessor.preprocess(f_obj))
+        assert fast == slow
+        assert fast.startswith("int a;%sint b;" % line_ending)
+        assert "2 b\r%slast" % line_ending in fast
+
+
+def test_verbatim_macro_line_with_line_ending():
+    f_obj = FakeFile("h.h", ["#define A 1\n", "A b\n", "c d\n"])
+    assert "".join(preprocess(f_obj, line_ending="\r")) == "1 b\rc d\r"
+
+
+def test_verbatim_tokens():
+    chunks = list(Tokenizer(VERBATIM_CASES, "\n", verbatim=True)
+                  .read_chunks())
+    verbatim = [
+        chunk[0].value for chunk in chunks
+        if chunk[0].type is TokenType.VERBATIM
+    ]
+    assert verbatim == [
+        "int a;\n", "int b;\n", "\n", "   \n",
+        "x = a / b;\n", "stray */ end\n", "int c = A;\n", "int d = A;\n",
+        "dead\n", "B b\r\n",
+    ]
+    assert all(len(chunk) == 1 for chunk in chunks
+               if chunk[0].type is TokenType.VERBATIM)
+    assert [chunk[0].line_no for chunk in chunks][:2] == [0, 1]
+
+
+def test_verbatim_line_source_map():
+    f_obj = FakeFile("header.h", ["#define A 1\n", "int a;\n", "A\n"])
+    source_map = SourceMap()
+    ret = preprocess(f_obj, source_map=source_map)
+    assert "".join(ret) == "int a;\n1\n"
+    assert list(source_map.lines) == [2, 3]
+
+
+def test_verbatim_non_ascii_identifier():
+    f_obj = FakeFile("header.h", ["#define G\n", "\tGé\n"])
+    fast = "".join(Preprocessor().preprocess(f_obj))
+    preprocessor = Preprocessor()
+    preprocessor.verbatim = False
+    assert fast == "".join(preprocessor.preprocess(f_obj)) == "\té\n"
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import pytest
 from simplecpreprocessor import preprocess
+from simplecpreprocessor.core import Preprocessor
 from simplecpreprocessor.filesystem import FakeFile
 from simplecpreprocessor.exceptions import ParseError
 
@@ -329,3 +330,44 @@ def test_pragma_whitespace_only():
     with pytest.raises(ParseError) as excinfo:
         "".join(preprocess(f_obj))
     assert "Unsupported pragma" in str(excinfo.value)
+
+
+def test_directives_skipped_in_inactive_block():
+    f_obj = FakeFile("header.h", ["#define X 1\n",
+                                  "#if 0\n",
+                                  "#include <does_not_exist.h>\n",
+                                  "#undef X\n",
+                                  "#error not reached\n",
+                                  "#pragma pack(1)\n",
+                                  "#endif\n",
+                                  "X\n"])
+    expected = "1\n"
+    run_case(f_obj, expected)
+
+
+def test_register_directive():
+    preprocessor = Preprocessor()
+    seen = []
+
+    def process_warning(line_no, chunk):
+        seen.append(line_no)
+        return ["warning", chunk[-1].value]
+
+    preprocessor.register_directive("warning", process_warning)
+    f_obj = FakeFile("header.h", ["#warning hello\n", "x\n"])
+    assert "".join(preprocessor.preprocess(f_obj)) == "warning\nx\n"
+    assert seen == [0]
+
+
+def test_register_pragma():
+    preprocessor = Preprocessor()
+    preprocessor.register_pragma("message", lambda **_: None)
+    f_obj = FakeFile("header.h", ['#pragma message("hi")\n', "x\n"])
+    assert "".join(preprocessor.preprocess(f_obj)) == "x\n"
+
+
+def test_invalid_octal_in_if_causes_error():
+    input_list = ["#if 08\n", "#endif\n"]
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(input_list))
+    assert "octal" in str(excinfo.value)
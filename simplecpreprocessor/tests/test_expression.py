@@ -339,3 +339,127 @@ def test_expression_token_attributes():
     token = ExpressionToken("NUMBER", "42")
     assert token.type == "NUMBER"
     assert token.value == "42"
+
+
+def test_logical_and_short_circuits_division_by_zero():
+    tokens = make_tokens(["defined", "(", "X", ")", "&&", "10", "/", "X"])
+    defines = Defines({})
+    result = evaluate_expression(tokens, defines)
+    assert result == 0
+
+
+def test_logical_or_short_circuits_division_by_zero():
+    tokens = make_tokens(["1", "||", "(", "1", "%", "0", ")"])
+    defines = Defines({})
+    result = evaluate_expression(tokens, defines)
+    assert result == 1
+
+
+def test_short_circuit_skips_nested_operators():
+    tokens = make_tokens(
+        ["0", "&&", "-", "(", "1", "/", "0", "+", "!", "defined", "A", ")",
+         "||", "2"]
+    )
+    defines = Defines({})
+    result = evaluate_expression(tokens, defines)
+    assert result == 1
+
+
+def test_short_circuit_chain_of_defined():
+    tokens = make_tokens(
+        ["defined", "A", "||", "defined", "B", "||", "defined", "C"]
+    )
+    defines = Defines({"A": []})
+    result = evaluate_expression(tokens, defines)
+    assert result == 1
+
+
+def test_short_circuit_still_checks_syntax():
+    tokens = make_tokens(["1", "||", "(", "2"])
+    defines = Defines({})
+    with pytest.raises(SyntaxError, match="Missing closing parenthesis"):
+        evaluate_expression(tokens, defines)
+
+
+def test_logical_and_evaluates_right_when_needed():
+    tokens = make_tokens(["1", "&&", "1", "/", "0"])
+    defines = Defines({})
+    with pytest.raises(ZeroDivisionError):
+        evaluate_expression(tokens, defines)
+
+
+def test_integer_literal_suffixes():
+    for literal in ["10U", "10L", "10UL", "10ull", "10LLu", "10lu"]:
+        tokens = make_tokens([literal])
+        assert evaluate_expression(tokens, Defines({})) == 10
+
+
+def test_integer_literal_bases():
+    tokens = make_tokens(["0x1F", "+", "010", "+", "0b11"])
+    assert evaluate_expression(tokens, Defines({})) == 42
+
+
+def test_integer_literal_invalid_octal():
+    for literal in ["08", "09U", "0778"]:
+        with pytest.raises(SyntaxError, match="octal"):
+            evaluate_expression(make_tokens([literal]), Defines({}))
+
+
+def test_unbounded_multiplication_does_not_wrap():
+    tokens = make_tokens(["4294967296", "*", "4294967296"])
+    assert evaluate_expression(tokens, Defines({})) == 2 ** 64
+
+
+def test_fixed_width_signed_wraparound():
+    tokens = make_tokens(["9223372036854775807", "+", "1"])
+    result = evaluate_expression(tokens, Defines({}), int_bits=64)
+    assert result == -2 ** 63
+
+
+def test_fixed_width_multiplication_stays_bounded():
+    tokens = make_tokens(["4294967296", "*", "4294967296"])
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == 0
+
+
+def test_fixed_width_unsigned_conversion():
+    tokens = make_tokens(["-", "1", "<", "0U"])
+    assert evaluate_expression(tokens, Defines({})) == 1
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == 0
+
+
+def test_fixed_width_unsigned_negation():
+    tokens = make_tokens(["-", "1U"])
+    result = evaluate_expression(tokens, Defines({}), int_bits=64)
+    assert result == 2 ** 64 - 1
+
+
+def test_fixed_width_large_literal_is_unsigned():
+    tokens = make_tokens(["0xFFFFFFFFFFFFFFFF", ">", "0"])
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == 1
+
+
+def test_fixed_width_division_truncates_toward_zero():
+    tokens = make_tokens(["-", "7", "/", "2"])
+    assert evaluate_expression(tokens, Defines({})) == -4
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == -3
+    tokens = make_tokens(["7", "/", "2"])
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == 3
+
+
+def test_fixed_width_modulo_sign_follows_dividend():
+    tokens = make_tokens(["-", "7", "%", "2"])
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == -1
+
+
+def test_fixed_width_division_by_zero():
+    tokens = make_tokens(["1", "/", "0"])
+    with pytest.raises(ZeroDivisionError, match="Division"):
+        evaluate_expression(tokens, Defines({}), int_bits=64)
+    tokens = make_tokens(["1", "%", "0"])
+    with pytest.raises(ZeroDivisionError, match="Modulo"):
+        evaluate_expression(tokens, Defines({}), int_bits=64)
+
+
+def test_fixed_width_logical_result_is_signed():
+    tokens = make_tokens(["(", "1U", "&&", "2", ")", "-", "2"])
+    assert evaluate_expression(tokens, Defines({}), int_bits=64) == -1
@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+import os
+import posixpath
+import mock
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.core import Preprocessor, Tag
+from simplecpreprocessor.filesystem import (
+    FakeFile, HeaderHandler, IndexedHeaderHandler, MemoryFile,
+)
+from simplecpreprocessor.guards import GuardDatabase
+from simplecpreprocessor.tokens import Tokenizer
+
+
+def write_headers(tmp_path):
+    (tmp_path / "guarded.h").write_text(
+        "#ifndef GUARDED_H\n#define GUARDED_H\nguarded\n#endif\n"
+    )
+    (tmp_path / "once.h").write_text("#pragma once\nonce\n")
+    (tmp_path / "plain.h").write_text("plain\n")
+    return tmp_path.as_posix()
+
+
+def run(include, lines, guard_database):
+    f_obj = FakeFile("main.c", lines)
+    return "".join(preprocess(f_obj, include_paths=[include],
+                              guard_database=guard_database))
+
+
+def test_guards_recorded(tmp_path):
+    include = write_headers(tmp_path)
+    database = GuardDatabase()
+    lines = ["#include <guarded.h>\n", "#include <once.h>\n",
+             "#include <plain.h>\n"]
+    assert run(include, lines, database) == "guarded\nonce\nplain\n"
+    guarded = os.path.realpath(str(tmp_path / "guarded.h"))
+    once = os.path.realpath(str(tmp_path / "once.h"))
+    assert database.lookup(guarded) == ("GUARDED_H", Tag.IFNDEF)
+    assert database.lookup(once) is Tag.PRAGMA_ONCE
+    assert database.lookup(str(tmp_path / "plain.h")) is None
+
+
+def test_guarded_header_skipped_without_reading(tmp_path):
+    include = write_headers(tmp_path)
+    database = GuardDatabase()
+    run(include, ["#include <guarded.h>\n", "#include <once.h>\n"],
+        database)
+    handler = HeaderHandler([include])
+    preprocessor = Preprocessor(header_handler=handler,
+                                guard_database=database)
+    f_obj = FakeFile("main.c", ["#define GUARDED_H\n",
+                                "#include <guarded.h>\n",
+                                "#include <once.h>\n",
+                                "#include <once.h>\n"])
+    with mock.patch("simplecpreprocessor.tokens.Tokenizer",
+                    wraps=Tokenizer) as tokenizer:
+        assert "".join(preprocessor.preprocess(f_obj)) == "once\n"
+    names = [call.args[0].name for call in tokenizer.call_args_list]
+    assert names == ["main.c", posixpath.join(include, "once.h")]
+
+
+def test_stale_entries_revalidated(tmp_path):
+    include = write_headers(tmp_path)
+    database = GuardDatabase()
+    run(include, ["#include <guarded.h>\n"], database)
+    guarded = str(tmp_path / "guarded.h")
+    st = os.stat(guarded)
+    os.utime(guarded, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert database.lookup(guarded) == ("GUARDED_H", Tag.IFNDEF)
+    (tmp_path / "guarded.h").write_text(
+        "#ifndef OTHER_H\n#define OTHER_H\nguarded\n#endif\n"
+    )
+    os.utime(guarded, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+    assert database.lookup(guarded) is None
+    run(include, ["#include <guarded.h>\n"], database)
+    (tmp_path / "guarded.h").write_text("changed size\n")
+    assert database.lookup(guarded) is None
+    (tmp_path / "once.h").unlink()
+    database.record(str(tmp_path / "once.h"), Tag.PRAGMA_ONCE)
+    assert database.lookup(str(tmp_path / "once.h")) is None
+
+
+def test_deleted_file_invalidated(tmp_path):
+    include = write_headers(tmp_path)
+    database = GuardDatabase()
+    run(include, ["#include <once.h>\n"], database)
+    (tmp_path / "once.h").unlink()
+    assert database.lookup(str(tmp_path / "once.h")) is None
+    assert database.entries == {}
+
+
+def test_save_and_load(tmp_path):
+    include = write_headers(tmp_path)
+    database = GuardDatabase()
+    run(include, ["#include <guarded.h>\n", "#include <once.h>\n"],
+        database)
+    path = str(tmp_path / "guards.json")
+    database.save(path)
+    loaded = GuardDatabase.load(path)
+    assert loaded.entries == database.entries
+    lines = ["#define GUARDED_H\n", "#include <guarded.h>\n",
+             "#include <once.h>\n"]
+    assert run(include, lines, loaded) == "once\n"
+
+
+def test_guarded_header_not_opened(tmp_path):
+    include = write_headers(tmp_path)
+    os.symlink(str(tmp_path / "guarded.h"), str(tmp_path / "alias.h"))
+    database = GuardDatabase()
+    run(include, ["#include <guarded.h>\n"], database)
+    handler = IndexedHeaderHandler([include])
+    f_obj = MemoryFile("main.c", "#define GUARDED_H\n#include <alias.h>\n")
+    with mock.patch.object(handler, "_open", wraps=handler._open) as opened:
+        ret = preprocess(f_obj, header_handler=handler,
+                         guard_database=database)
+        assert "".join(ret) == ""
+    assert opened.call_count == 0
+
+
+def test_record_hashes_file(tmp_path):
+    write_headers(tmp_path)
+    plain = str(tmp_path / "plain.h")
+    database = GuardDatabase()
+    database.record(plain, Tag.PRAGMA_ONCE)
+    st = os.stat(plain)
+    os.utime(plain, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert database.lookup(plain) is Tag.PRAGMA_ONCE
+
+
+def test_binary_entries_revalidated(tmp_path):
+    (tmp_path / "vendor.h").write_bytes(b"#pragma once\n\xff\r\n")
+    database = GuardDatabase()
+    f_obj = FakeFile("main.c", [b"#include <vendor.h>\n"])
+    "".join(preprocess(f_obj, include_paths=[tmp_path.as_posix()],
+                       guard_database=database, binary=True))
+    vendor = str(tmp_path / "vendor.h")
+    st = os.stat(vendor)
+    os.utime(vendor, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert database.lookup(vendor, binary=True) is Tag.PRAGMA_ONCE
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.headerfilter import HeaderFilter, glob_to_regex
+
+
+@pytest.mark.parametrize("pattern,header,expected", [
+    ("windows.h", "windows.h", True),
+    ("windows.h", "sys/windows.h", False),
+    ("windows*.h", "windowsx.h", True),
+    ("windows*.h", "windows/x.h", False),
+    ("win?.h", "win3.h", True),
+    ("win?.h", "win/.h", False),
+    ("sys/**", "sys/types.h", True),
+    ("sys/**", "sys/a/b.h", True),
+    ("sys/**", "other/sys/a.h", False),
+    ("**/config.h", "config.h", True),
+    ("**/config.h", "a/b/config.h", True),
+    ("**/config.h", "a/b/myconfig.h", False),
+    ("[ab].h", "a.h", True),
+    ("[ab].h", "c.h", False),
+    ("[!ab].h", "c.h", True),
+    ("[!ab].h", "a.h", False),
+    ("[.h", "[.h", True),
+    ("a+b?.h", "a+bc.h", True),
+    ("re:(linux|win)_.*\\.h", "linux_io.h", True),
+    ("re:(linux|win)_.*\\.h", "mac_io.h", False),
+])
+def test_header_filter(pattern, header, expected):
+    assert (header in HeaderFilter([pattern])) is expected
+
+
+def test_header_filter_combined():
+    header_filter = HeaderFilter(["a.h", "b*.h", "re:c[0-9]\\.h"])
+    assert header_filter.exact == frozenset(["a.h"])
+    assert "a.h" in header_filter
+    assert "bb.h" in header_filter
+    assert "c1.h" in header_filter
+    assert "d.h" not in header_filter
+    assert "d.h" not in HeaderFilter(["a.h"])
+    assert HeaderFilter.from_patterns(header_filter) is header_filter
+    assert HeaderFilter.from_patterns(["a.h"]).patterns == ("a.h",)
+
+
+def test_glob_to_regex():
+    assert glob_to_regex("a\\[b].h") == "a\\\\[b]\\.h"
+    assert glob_to_regex("[\\a].h") == "[\\\\a]\\.h"
+
+
+def test_ignore_header_patterns():
+    f_obj = FakeFile("main.c", ["#include <windows.h>\n",
+                                "#include <sys/types.h>\n",
+                                "#include <kept.h>\n"])
+    handler = FakeHandler({"kept.h": ["kept\n"]}, include_paths=["."])
+    header_filter = HeaderFilter(["windows*.h", "sys/**"])
+    for _ in range(2):
+        ret = preprocess(f_obj, header_handler=handler,
+                         ignore_headers=header_filter)
+        assert "".join(ret) == "kept\n"
+
+
+def test_regex_patterns_keep_groups_and_flags():
+    header_filter = HeaderFilter(["x*.h", "re:(a|b)_\\1\\.h", "re:(?i)win.*"])
+    assert "a_a.h" in header_filter
+    assert "b_b.h" in header_filter
+    assert "a_b.h" not in header_filter
+    assert "WINDOWS.H" in header_filter
+    assert "X.H" not in header_filter
+    assert "xy.h" in header_filter
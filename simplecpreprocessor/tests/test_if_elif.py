@@ -426,3 +426,25 @@ def test_deeply_nested_elif_inner():
     ])
     expected = "B\n"
     run_case(f_obj, expected)
+
+
+def test_if_short_circuit_guards_division():
+    f_obj = FakeFile("header.h", [
+        "#if defined(X) && 10 / X\n",
+        "X\n",
+        "#else\n",
+        "Y\n",
+        "#endif\n"
+    ])
+    expected = "Y\n"
+    run_case(f_obj, expected)
+
+
+def test_if_fixed_width_arithmetic():
+    f_obj = FakeFile("header.h", [
+        "#if 0xFFFFFFFFFFFFFFFFULL + 1 == 0\n",
+        "X\n",
+        "#endif\n"
+    ])
+    ret = preprocess(f_obj, int_bits=64)
+    assert "".join(ret) == "X\n"
@@ -1,10 +1,20 @@
 from __future__ import absolute_import
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
 import posixpath
 import ntpath
-from simplecpreprocessor import preprocess
-from simplecpreprocessor.core import Preprocessor
+import tarfile
+import zipfile
+from simplecpreprocessor import preprocess, preprocess_to_file
+from simplecpreprocessor.core import Preprocessor, Tag, include_target
 from simplecpreprocessor.exceptions import ParseError
-from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.filesystem import (
+    ArchiveHandler, ContentCache, DirectoryIndex, FakeFile, FakeHandler,
+    HeaderHandler, IndexedHeaderHandler, MemoryFile, MemoryHandler,
+    SKIP_FILE, TokenCache,
+)
+from simplecpreprocessor.tokens import Tokenizer
 import mock
 import pytest
 
@@ -313,3 +323,796 @@ def test_include_angle_bracket_eof_no_newline():
     with pytest.raises(ParseError) as excinfo:
         "".join(preprocess(f_obj))
     assert "missing '>'" in str(excinfo.value)
+
+
+class CountingHandler(FakeHandler):
+
+    def __init__(self, header_mapping, include_paths=()):
+        super(CountingHandler, self).__init__(header_mapping, include_paths)
+        self.opened = []
+
+    def _open(self, header_path):
+        self.opened.append(header_path)
+        return super(CountingHandler, self)._open(header_path)
+
+
+def test_include_resolution_keyed_by_directory():
+    f_obj = FakeFile("header.h", ['#include "a/x.h"\n',
+                                  '#include "b/x.h"\n'])
+    handler = FakeHandler({"a/x.h": ['#include "config.h"\n'],
+                           "b/x.h": ['#include "config.h"\n'],
+                           "a/config.h": ["a\n"],
+                           "b/config.h": ["b\n"]})
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "a\nb\n"
+
+
+def test_include_resolution_negative_cache():
+    handler = CountingHandler({}, include_paths=["one", "two"])
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    assert handler.opened == ["one/x.h", "two/x.h"]
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    assert handler.open_header("x.h", lambda _: False, "one/y.h") is None
+    assert handler.opened == ["one/x.h", "two/x.h"]
+
+
+def test_include_resolution_invalidate():
+    handler = CountingHandler({}, include_paths=["one"])
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    handler.header_mapping["one/x.h"] = ["1\n"]
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    handler.invalidate("y.h")
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    handler.invalidate("x.h")
+    f_obj = handler.open_header("x.h", lambda _: False, None)
+    assert f_obj.name == "one/x.h"
+
+
+def test_include_resolution_cached_positive():
+    handler = CountingHandler({"one/x.h": ["1\n"]}, include_paths=["one"])
+    assert handler.open_header("x.h", lambda _: False, None).name == "one/x.h"
+    assert handler.open_header("x.h", lambda _: True, None) is SKIP_FILE
+    assert handler.open_header("x.h", lambda _: False, None).name == "one/x.h"
+    assert handler.opened == ["one/x.h", "one/x.h"]
+
+
+def test_include_resolution_stale_entry():
+    handler = FakeHandler({"one/x.h": ["1\n"], "two/x.h": ["2\n"]},
+                          include_paths=["one", "two"])
+    assert handler.open_header("x.h", lambda _: False, None).name == "one/x.h"
+    del handler.header_mapping["one/x.h"]
+    assert handler.open_header("x.h", lambda _: False, None).name == "two/x.h"
+
+
+def test_add_include_paths_invalidates():
+    handler = FakeHandler({"two/x.h": ["2\n"]}, include_paths=["one"])
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    handler.add_include_paths([])
+    assert handler.open_header("x.h", lambda _: False, None) is None
+    handler.add_include_paths(["two"])
+    assert handler.open_header("x.h", lambda _: False, None).name == "two/x.h"
+
+
+def test_include_preresolved_skip():
+    handler = FakeHandler({"one/x.h": ["1\n"]})
+    handler.resolved["x.h"] = "one/x.h"
+    assert handler.open_header("x.h", lambda _: True, None) is SKIP_FILE
+
+
+def make_tree(tmp_path):
+    include = tmp_path / "include"
+    (include / "sys").mkdir(parents=True)
+    (include / "sys" / "types.h").write_text("types\n")
+    (include / "top.h").write_text('#include <sys/types.h>\n')
+    return posixpath.join(tmp_path.as_posix(), "include")
+
+
+def test_indexed_handler_resolves_headers(tmp_path):
+    include = make_tree(tmp_path)
+    handler = IndexedHeaderHandler([posixpath.join(include, "missing"),
+                                    include])
+    f_obj = FakeFile("header.h", ["#include <top.h>\n"])
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "types\n"
+    assert handler.index.exists(posixpath.join(include, "sys", "types.h"))
+    assert not handler.index.exists(posixpath.join(include, "nope",
+                                                   "types.h"))
+    assert not handler.index.exists(posixpath.join(include, "top.h", "x"))
+
+
+def test_indexed_handler_skips_open_for_missing(tmp_path):
+    include = make_tree(tmp_path)
+    handler = IndexedHeaderHandler([include])
+    with mock.patch("builtins.open") as mock_open:
+        assert handler.open_header("nope.h", lambda _: False, None) is None
+        assert handler.open_header("sys/nope.h", lambda _: False,
+                                   None) is None
+        assert handler._open(posixpath.join(include, "nope.h")) is None
+    assert not mock_open.called
+
+
+def test_indexed_handler_relative_parent(tmp_path):
+    include = make_tree(tmp_path)
+    handler = IndexedHeaderHandler([posixpath.join(include, "sys")])
+    f_obj = handler.open_header("../top.h", lambda _: False, None)
+    with f_obj:
+        assert f_obj.read() == '#include <sys/types.h>\n'
+
+
+def test_directory_index_save_and_load(tmp_path):
+    include = make_tree(tmp_path)
+    index = DirectoryIndex()
+    assert index.exists(posixpath.join(include, "sys", "types.h"))
+    index_path = str(tmp_path / "index.json")
+    index.save(index_path)
+    loaded = DirectoryIndex.load(index_path)
+    with mock.patch("os.scandir") as mock_scandir:
+        assert loaded.exists(posixpath.join(include, "sys", "types.h"))
+        assert not loaded.exists(posixpath.join(include, "sys", "x.h"))
+    assert not mock_scandir.called
+    loaded.clear()
+    assert loaded.listings == {}
+
+
+def test_directory_index_stale_and_special_entries(tmp_path):
+    base = tmp_path.as_posix()
+    (tmp_path / "dangling.h").symlink_to(tmp_path / "nowhere.h")
+    index = DirectoryIndex({base: [[], ["gone"]]})
+    assert not index.exists(posixpath.join(base, "gone", "x.h"))
+    index = DirectoryIndex()
+    assert not index.exists(posixpath.join(base, "dangling.h"))
+
+
+def test_content_cache_shared_between_runs(tmp_path):
+    include = make_tree(tmp_path)
+    cache = ContentCache()
+    handler = HeaderHandler([include], content_cache=cache)
+    f_obj = FakeFile("header.h", ["#include <top.h>\n"])
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "types\n"
+    with mock.patch("builtins.open") as mock_open:
+        handler = HeaderHandler([include], content_cache=cache)
+        f_obj = FakeFile("header.h", ["#include <top.h>\n"])
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "types\n"
+    assert not mock_open.called
+    assert cache.size == len('#include <sys/types.h>\n') + len("types\n")
+
+
+def test_content_cache_revalidates(tmp_path):
+    header = tmp_path / "x.h"
+    header.write_text("old\n")
+    handler = HeaderHandler([tmp_path.as_posix()],
+                            content_cache=ContentCache())
+    with handler.open_header("x.h", lambda _: False, None) as f_obj:
+        assert f_obj.read() == "old\n"
+    header.write_text("newer\n")
+    with handler.open_header("x.h", lambda _: False, None) as f_obj:
+        assert list(f_obj) == ["newer\n"]
+    assert handler.open_header("y.h", lambda _: False, None) is None
+
+
+def test_content_cache_lru_eviction():
+    cache = ContentCache(max_bytes=10)
+    cache.put("a", (1, 4), "aaaa")
+    cache.put("b", (1, 4), "bbbb")
+    assert cache.get("a", (1, 4)) == "aaaa"
+    cache.put("c", (1, 4), "cccc")
+    assert cache.get("b", (1, 4)) is None
+    assert cache.get("a", (1, 4)) == "aaaa"
+    assert cache.get("a", (2, 4)) is None
+    cache.put("a", (2, 5), "aaaaa")
+    assert cache.size == 9
+    cache.put("big", (1, 11), "x" * 11)
+    assert cache.get("big", (1, 11)) is None
+    cache.clear()
+    assert cache.size == 0 and not cache.entries
+
+
+def run_guard_case(other_lines, main_lines=None):
+    if main_lines is None:
+        main_lines = ['#include "other.h"\n', '#include "other.h"\n']
+    f_obj = FakeFile("header.h", main_lines)
+    handler = FakeHandler({"other.h": other_lines})
+    preprocessor = Preprocessor(header_handler=handler)
+    output = "".join(preprocessor.preprocess(f_obj))
+    return preprocessor, output
+
+
+def test_fullfile_guard_after_comment_and_blank_lines():
+    preprocessor, output = run_guard_case([
+        "/* License text\n",
+        " * spanning lines */\n",
+        "\n",
+        "// more comments\n",
+        "#ifndef OTHER_H\n",
+        "#define OTHER_H\n",
+        "x\n",
+        "#endif /* OTHER_H */\n",
+        "\n",
+        "   \n",
+        "// trailing comment\n"])
+    assert output.count("x") == 1
+    assert preprocessor.include_once == {
+        "other.h": ("OTHER_H", Tag.IFNDEF)}
+
+
+@pytest.mark.parametrize("condition", [
+    "!defined(OTHER_H)", "!defined OTHER_H", "! defined ( OTHER_H )"])
+def test_fullfile_guard_if_not_defined(condition):
+    preprocessor, output = run_guard_case([
+        "#if %s\n" % condition,
+        "#define OTHER_H\n",
+        "x\n",
+        "#endif\n"])
+    assert output.count("x") == 1
+    assert preprocessor.include_once == {
+        "other.h": ("OTHER_H", Tag.IFNDEF)}
+
+
+@pytest.mark.parametrize("other_lines", [
+    ["#if !defined(OTHER_H) && 1\n", "#define OTHER_H\n", "#endif\n"],
+    ["#if !defined(A) || !defined(B)\n", "#endif\n"],
+    ["#if 1\n", "#endif\n"],
+    ["#ifndef OTHER_H\n", "#define OTHER_H\n", "#else\n", "#endif\n"],
+    ["#ifdef OTHER_H\n", "#elif 1\n", "#endif\n"],
+    ["int x;\n", "#ifndef OTHER_H\n", "#define OTHER_H\n", "#endif\n"],
+])
+def test_not_a_fullfile_guard(other_lines):
+    preprocessor, _ = run_guard_case(other_lines)
+    assert preprocessor.include_once == {}
+
+
+def test_fullfile_guard_not_inherited_from_last_include():
+    f_obj = FakeFile("header.h", ['#include "outer.h"\n'])
+    handler = FakeHandler({
+        "outer.h": ['#include "inner.h"\n'],
+        "inner.h": ["#ifndef INNER_H\n", "#define INNER_H\n", "#endif\n"]})
+    preprocessor = Preprocessor(header_handler=handler)
+    "".join(preprocessor.preprocess(f_obj))
+    assert preprocessor.include_once == {
+        "inner.h": ("INNER_H", Tag.IFNDEF)}
+
+
+def test_pragma_once_through_symlink_and_parent_segments(tmp_path):
+    include = tmp_path / "include"
+    (include / "sub").mkdir(parents=True)
+    (include / "once.h").write_text("#pragma once\nonce\n")
+    (tmp_path / "link").symlink_to(include)
+    (tmp_path / "alias.h").symlink_to(include / "once.h")
+    base = tmp_path.as_posix()
+    f_obj = FakeFile("main.c", ["#include <include/once.h>\n",
+                                "#include <link/once.h>\n",
+                                "#include <include/sub/../once.h>\n",
+                                "#include <alias.h>\n"])
+    ret = preprocess(f_obj, include_paths=[base])
+    assert "".join(ret) == "once\n"
+
+
+def test_file_identity(tmp_path):
+    header = tmp_path / "x.h"
+    header.write_text("x\n")
+    handler = HeaderHandler([])
+    st = os.stat(str(header))
+    assert handler.file_identity(str(header)) == (st.st_dev, st.st_ino)
+    missing = str(tmp_path / "missing.h")
+    assert handler.file_identity(missing) == os.path.realpath(missing)
+    header.unlink()
+    assert handler.file_identity(str(header)) == (st.st_dev, st.st_ino)
+    handler.invalidate()
+    assert handler.file_identity(str(header)) == os.path.realpath(
+        str(header))
+
+
+def test_content_cache_shared_through_symlink(tmp_path):
+    (tmp_path / "x.h").write_text("x\n")
+    (tmp_path / "y.h").symlink_to(tmp_path / "x.h")
+    cache = ContentCache()
+    handler = HeaderHandler([tmp_path.as_posix()], content_cache=cache)
+    for name in ("x.h", "y.h"):
+        with handler.open_header(name, lambda _: False, None) as f_obj:
+            assert f_obj.read() == "x\n"
+    assert len(cache.entries) == 1
+
+
+def test_token_cache_shares_identical_headers():
+    cache = TokenCache()
+    header = ["#pragma once\n", "#define X 1\n", "X\n"]
+    handler = FakeHandler({"a/x.h": header, "b/x.h": list(header)},
+                          token_cache=cache)
+    f_obj = FakeFile("main.c", ['#include "a/x.h"\n',
+                                '#include "b/x.h"\n',
+                                '#include "a/x.h"\n'])
+    path = "simplecpreprocessor.tokens.Tokenizer"
+    with mock.patch(path, wraps=Tokenizer) as tokenizer:
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "1\n1\n"
+    # main.c and one shared tokenization of the headers, besides the
+    # rescanner of lines that use macros
+    files = [call for call in tokenizer.call_args_list
+             if call[0][0] != ()]
+    assert len(files) == 2
+    assert len(cache.entries) == 2
+
+
+def test_token_cache_line_ending_and_budget():
+    cache = TokenCache(max_bytes=4)
+    assert "".join(
+        t.value for c in cache.read_chunks("ab\n", "\r\n") for t in c
+    ) == "ab\r\n"
+    assert cache.read_chunks("ab\n", "\n") is not cache.read_chunks(
+        "ab\n", "\r\n")
+    assert len(cache.entries) == 1
+    assert cache.size == 3
+    cache.read_chunks("too long\n", "\n")
+    assert len(cache.entries) == 1
+    chunks = cache.read_chunks("ab\n", "\n")
+    assert cache.read_chunks("ab\n", "\n") is chunks
+    cache.clear()
+    assert not cache.entries
+    assert cache.size == 0
+
+
+def test_prefetch_includes():
+    f_obj = FakeFile("main.c", ['#include "a.h"\n',
+                                "#include <b.h>\n",
+                                "#include <missing.h>\n"])
+    handler = CountingHandler({"a.h": ['#include "c.h"\n', "a\n"],
+                               "b.h": ["#pragma once\n", "b\n"],
+                               "c.h": ["#pragma once\n", "c\n"]},
+                              include_paths=["."])
+    preprocessor = Preprocessor(header_handler=handler, prefetch=True)
+    with pytest.raises(ParseError):
+        "".join(preprocessor.preprocess(f_obj))
+    assert not handler.pending
+    assert isinstance(handler.executor, ThreadPoolExecutor)
+    # The second prefetch of b.h and c.h is skipped by #pragma once
+    f_obj = FakeFile("main.c", ["#include <b.h>\n", '#include "c.h"\n'])
+    del handler.opened[:]
+    assert "".join(preprocessor.preprocess(f_obj)) == ""
+    assert handler.opened == []
+
+
+def test_prefetched_file_is_used():
+    f_obj = FakeFile("main.c", ['#include "a.h"\n',
+                                "#include <a.h>\n",
+                                "#include <x.h>\n",
+                                "#include <ignored.h>\n"])
+    handler = CountingHandler({"a.h": ["a\n"], "one/x.h": ["x\n"]},
+                              include_paths=["."])
+    handler.resolved["x.h"] = "one/x.h"
+    handler.executor = mock.Mock()
+    futures = []
+
+    def submit(job, *args):
+        future = mock.Mock()
+        future.result.return_value = job(*args)
+        futures.append(future)
+        return future
+    handler.executor.submit.side_effect = submit
+    ret = preprocess(f_obj, header_handler=handler, prefetch=True,
+                     ignore_headers=["ignored.h"])
+    assert "".join(ret) == "a\na\nx\n"
+    assert len(futures) == 3
+    assert handler.opened == ["a.h", "a.h", "one/x.h"]
+    assert not handler.pending
+
+
+def test_prefetch_cached_resolutions():
+    handler = CountingHandler({"a.h": ["a\n"]}, include_paths=["."])
+    handler.executor = mock.Mock()
+    skip = mock.Mock(return_value=False)
+    assert handler.open_header("missing.h", skip, None) is None
+    handler.prefetch("missing.h", skip, None, "\n")
+    assert not handler.pending
+    assert handler.open_header("a.h", skip, None).name == "a.h"
+    skip.return_value = True
+    handler.prefetch("a.h", skip, None, "\n")
+    assert not handler.pending
+    skip.return_value = False
+    handler.prefetch("a.h", skip, None, "\n")
+    handler.prefetch("a.h", skip, None, "\n")
+    assert handler.executor.submit.call_count == 1
+    job, candidates = handler.executor.submit.call_args[0][:2]
+    assert candidates == ["a.h"]
+    handler.prefetch("missing.h", skip, "x/y.c", "\n")
+    job, candidates = handler.executor.submit.call_args[0][:2]
+    assert candidates == ["x/missing.h"]
+    handler.invalidate()
+    assert not handler.pending
+
+
+def test_prefetched_file_line_ending():
+    handler = FakeHandler({"a.h": ["a\n"]}, include_paths=["."])
+    f_obj = handler._prefetch_job(["missing.h", "a.h"], "\n")
+    assert f_obj.read() == "a\n"
+    chunks = list(handler.read_chunks(f_obj, "\r\n"))
+    assert chunks[0][-1].value == "\r\n"
+    assert handler._prefetch_job(["missing.h"], "\n") is None
+
+
+def test_include_target():
+    def target(text):
+        chunk = next(Tokenizer([text], "\n").read_chunks())
+        return include_target(chunk[2:])
+    assert target('#include "a.h"\n') == ("a.h", True)
+    assert target('#include u8"a.h"\n') == ("a.h", True)
+    assert target("#include <sys/a.h>\n") == ("sys/a.h", False)
+    assert target("#include <a.h\n") is None
+    assert target("#include a.h\n") is None
+    assert target("#include\n") is None
+
+
+def make_archive_members():
+    return {
+        "sdk/include/api.h": '#pragma once\n#include "detail/impl.h"\napi\n',
+        "sdk/include/detail/impl.h": "#include <config.h>\nimpl\n",
+        "sdk/config/config.h": "config\n",
+    }
+
+
+def check_archive_handler(handler):
+    f_obj = FakeFile("main.c", ["#include <api.h>\n", "#include <api.h>\n"])
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "config\nimpl\napi\n"
+    f_obj = FakeFile("main.c", ["#include <missing.h>\n"])
+    with pytest.raises(ParseError):
+        "".join(preprocess(f_obj, header_handler=handler))
+    assert handler._open("sdk/include/missing.h") is None
+
+
+def test_zip_archive_handler(tmp_path):
+    path = str(tmp_path / "sdk.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("sdk/include/", "")
+        for name, text in make_archive_members().items():
+            archive.writestr(name, text)
+    with ArchiveHandler(path, ["sdk/include", "sdk/config"]) as handler:
+        assert "sdk/include" not in handler.members
+        check_archive_handler(handler)
+
+
+def test_tar_archive_handler(tmp_path):
+    path = str(tmp_path / "sdk.tar")
+    with tarfile.open(path, "w") as archive:
+        info = tarfile.TarInfo("./sdk/include")
+        info.type = tarfile.DIRTYPE
+        archive.addfile(info)
+        for name, text in make_archive_members().items():
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo("./" + name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    with ArchiveHandler(path, ["sdk/include", "sdk/config"]) as handler:
+        assert "sdk/include" not in handler.members
+        assert handler.file_identity("sdk/include/../config/config.h") == (
+            path, "sdk/config/config.h")
+        check_archive_handler(handler)
+    assert handler.archive.closed
+
+
+def test_memory_handler(tmp_path):
+    (tmp_path / "disk.h").write_text("disk\n")
+    (tmp_path / "shadowed.h").write_text("disk\n")
+    base = tmp_path.as_posix()
+    handler = MemoryHandler({
+        "gen/a.h": '#pragma once\n#include "b.h"\na\n',
+        "gen/b.h": b"b\n",
+        base + "/shadowed.h": memoryview(b"memory\n"),
+    }, include_paths=["gen", base])
+    f_obj = MemoryFile("main.c", "#include <a.h>\n#include <gen/../gen/a.h>\n"
+                                 "#include <disk.h>\n#include <shadowed.h>\n")
+    ret = preprocess(f_obj, header_handler=handler, include_paths=["."])
+    assert "".join(ret) == "b\na\ndisk\nmemory\n"
+    assert handler.file_identity("gen/x/../a.h") == ("<memory>", "gen/a.h")
+    handler.add("gen/b.h", "changed\n")
+    f_obj = MemoryFile("main.c", '#include "gen/b.h"\n')
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "changed\n"
+
+
+def test_memory_handler_token_cache():
+    handler = MemoryHandler({"a.h": "a\n", "b.h": "a\n"}, ["."],
+                            token_cache=TokenCache())
+    f_obj = MemoryFile("main.c", "#include <a.h>\n#include <b.h>\n")
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "a\na\n"
+    assert len(handler.token_cache.entries) == 2
+
+
+class TrackedFile(FakeFile):
+
+    def __init__(self, name, contents, log):
+        super(TrackedFile, self).__init__(name, contents)
+        self.log = log
+
+    def __enter__(self):
+        self.log.append("open " + self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.log.append("close " + self.name)
+
+
+class TrackingHandler(FakeHandler):
+
+    def __init__(self, header_mapping):
+        super(TrackingHandler, self).__init__(header_mapping, ["."])
+        self.log = []
+
+    def _open(self, header_path):
+        contents = self.header_mapping.get(header_path)
+        if contents is not None:
+            return TrackedFile(header_path, contents, self.log)
+        return None
+
+
+def test_deep_include_chain():
+    depth = 1000
+    mapping = {
+        "h%d.h" % i: ['#include "h%d.h"\n' % (i + 1), "%d\n" % i]
+        for i in range(depth)
+    }
+    mapping["h%d.h" % depth] = ["end\n"]
+    handler = TrackingHandler(mapping)
+    f_obj = FakeFile("main.c", ['#include "h0.h"\n'])
+    ret = preprocess(f_obj, header_handler=handler,
+                     max_include_depth=depth + 2)
+    output = "".join(ret).split()
+    assert output[0] == "end"
+    assert output[-1] == "0"
+    assert len(output) == depth + 1
+    assert handler.log[0] == "open h0.h"
+    assert handler.log[-1] == "close h0.h"
+    assert len(handler.log) == 2 * (depth + 1)
+
+
+def test_include_depth_limit():
+    handler = TrackingHandler({"a.h": ['#include "b.h"\n'],
+                               "b.h": ['#include "c.h"\n'],
+                               "c.h": ["c\n"]})
+    f_obj = FakeFile("main.c", ['#include "a.h"\n'])
+    assert "".join(preprocess(f_obj, header_handler=handler,
+                              max_include_depth=4)) == "c\n"
+    del handler.log[:]
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, header_handler=handler,
+                           max_include_depth=3))
+    assert str(excinfo.value) == (
+        "Include chain main.c -> a.h -> b.h -> c.h exceeds include depth "
+        "limit 3"
+    )
+    assert handler.log == ["open a.h", "open b.h", "open c.h",
+                           "close c.h", "close b.h", "close a.h"]
+
+
+def test_include_cycle():
+    handler = TrackingHandler({"a.h": ["a\n", '#include "b.h"\n'],
+                               "b.h": ['#include "./a.h"\n']})
+    f_obj = FakeFile("main.c", ['#include "a.h"\n'])
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, header_handler=handler))
+    assert str(excinfo.value) == (
+        "Include cycle a.h -> b.h -> a.h is not stopped by a guard or "
+        "conditional"
+    )
+    assert handler.log == ["open a.h", "open b.h", "open a.h",
+                           "close a.h", "close b.h", "close a.h"]
+
+
+def test_include_cycle_in_conditional():
+    handler = TrackingHandler({
+        "a.h": ["#ifndef A\n", "#define A\n", '#include "b.h"\n', "a\n",
+                "#endif\n"],
+        "b.h": ['#include "a.h"\n', "b\n"],
+        "c.h": ["#ifndef C\n", "#define C\n", "once\n", '#include "c.h"\n',
+                "#else\n", "again\n", "#endif\n"],
+    })
+    f_obj = FakeFile("main.c", ['#include "a.h"\n', '#include "c.h"\n'])
+    ret = preprocess(f_obj, header_handler=handler, max_include_depth=4)
+    assert "".join(ret) == "b\na\nonce\nagain\n"
+    handler = TrackingHandler({"a.h": ["#if 1\n", '#include "a.h"\n',
+                                       "#endif\n"]})
+    f_obj = FakeFile("main.c", ['#include "a.h"\n'])
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, header_handler=handler))
+    assert str(excinfo.value).startswith("Include cycle a.h -> a.h -> a.h")
+    assert str(excinfo.value).endswith("exceeds include depth limit 200")
+
+
+def test_error_in_include_closes_files():
+    handler = TrackingHandler({"a.h": ['#include "b.h"\n'],
+                               "b.h": ["#error broken\n"]})
+    f_obj = FakeFile("main.c", ['#include "a.h"\n'])
+    preprocessor = Preprocessor(header_handler=handler)
+    with pytest.raises(ParseError):
+        "".join(preprocessor.preprocess(f_obj))
+    assert handler.log == ["open a.h", "open b.h", "close b.h", "close a.h"]
+    assert preprocessor.file_stack == []
+
+
+def test_binary_mode(tmp_path):
+    (tmp_path / "vendor.h").write_bytes(b"#define X \"\xff\xfe\"\n\xe4 X\n")
+    (tmp_path / "main.c").write_bytes(
+        b'#include "vendor.h"\n\xc3\xa4 /* \x80 */ X\n'
+    )
+    output = io.BytesIO()
+    with open(str(tmp_path / "main.c"), "rb") as f_obj:
+        preprocess_to_file(f_obj, output, binary=True,
+                           include_paths=[tmp_path.as_posix()])
+    assert output.getvalue() == (
+        b"\xe4 \"\xff\xfe\"\n\xc3\xa4 \"\xff\xfe\"\n"
+    )
+
+
+def test_binary_mode_handlers(tmp_path):
+    data = b"\xff\n"
+    path = str(tmp_path / "sdk.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("a.h", data)
+    handler = MemoryHandler({"b.h": memoryview(data)}, binary=True)
+    f_obj = FakeFile("main.c", [b'#include "b.h"\n'])
+    output = io.BytesIO()
+    preprocess_to_file(f_obj, output, binary=True, header_handler=handler)
+    assert output.getvalue() == data
+    f_obj = FakeFile("main.c", ["#include <a.h>\n"])
+    with ArchiveHandler(path, ["."], binary=True) as handler:
+        output = io.BytesIO()
+        preprocess_to_file(f_obj, output, binary=True, header_handler=handler)
+    assert output.getvalue() == data
+
+
+def test_prefetched_file_skipped():
+    handler = FakeHandler({"a.h": ["a\n"]}, include_paths=["."])
+    handler.executor = mock.Mock()
+    handler.executor.submit.side_effect = lambda job, *args: mock.Mock(
+        **{"result.return_value": job(*args)}
+    )
+    skip = mock.Mock(return_value=False)
+    handler.prefetch("a.h", skip, None, "\n")
+    skip.return_value = True
+    assert handler.open_header("a.h", skip, None) is SKIP_FILE
+    assert handler.resolution_cache[(None, "a.h", False)] == "a.h"
+
+
+def test_prefetch_only_active_blocks():
+    f_obj = FakeFile("main.c", ["#if 0\n", '#include "dead.h"\n',
+                                "#endif\n", "#ifndef G\n",
+                                '#include "a.h"\n', "#endif\n"])
+    handler = CountingHandler({"a.h": ["a\n"], "dead.h": ["dead\n"]},
+                              include_paths=["."])
+    with handler:
+        ret = preprocess(f_obj, header_handler=handler, prefetch=True)
+        assert "".join(ret) == "a\n"
+        executor = handler.executor
+    assert handler.opened == ["a.h"]
+    assert handler.executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(len, "")
+
+
+def test_unused_prefetches_cancelled():
+    handler = CountingHandler({"b.h": ["b\n"]}, include_paths=["."])
+    futures = []
+
+    def submit(job, *args):
+        future = mock.Mock()
+        future.result.return_value = job(*args)
+        futures.append(future)
+        return future
+    executor = handler.executor = mock.Mock(**{"submit.side_effect": submit})
+    handler.owns_executor = False
+    f_obj = FakeFile("main.c", ['#include "missing.h"\n', '#include "b.h"\n'])
+    with pytest.raises(ParseError):
+        "".join(preprocess(f_obj, header_handler=handler, prefetch=True))
+    assert not handler.pending
+    assert [future.cancel.called for future in futures] == [False, True]
+    handler.close()
+    assert handler.executor is executor
+    assert not executor.shutdown.called
+
+
+def test_indexed_handler_invalidate(tmp_path):
+    include = make_tree(tmp_path)
+    handler = IndexedHeaderHandler([include])
+    skip = mock.Mock(return_value=False)
+    assert handler.open_header("new.h", skip, None) is None
+    assert handler.open_header("new.h", skip, "x/main.c") is None
+    assert handler.open_header("sys/new.h", skip, "x/main.c") is None
+    (tmp_path / "include" / "new.h").write_text("new\n")
+    (tmp_path / "include" / "sys" / "new.h").write_text("sys new\n")
+    handler.invalidate("new.h")
+    with handler.open_header("new.h", skip, None) as f_obj:
+        assert f_obj.read() == "new\n"
+    assert handler.open_header("sys/new.h", skip, "x/main.c") is None
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "other.h").write_text("other\n")
+    handler.invalidate()
+    with handler.open_header("sys/new.h", skip, "x/main.c") as f_obj:
+        assert f_obj.read() == "sys new\n"
+    assert handler.open_header("other.h", skip, None) is None
+    handler.add_include_paths([(tmp_path / "other").as_posix()])
+    with handler.open_header("other.h", skip, None) as f_obj:
+        assert f_obj.read() == "other\n"
+
+
+def test_directory_index_case_insensitive():
+    listings = {"": [[], ["Inc"]], "Inc": [["Foo.h"], ["Sys"]]}
+    index = DirectoryIndex(listings, case_sensitive=False)
+    assert index.exists("inc/FOO.h")
+    assert index.is_dir("INC/sys")
+    assert not index.exists("inc/bar.h")
+    index = DirectoryIndex(listings, case_sensitive=True)
+    assert index.exists("Inc/Foo.h")
+    assert not index.exists("inc/Foo.h")
+    assert not index.exists("Inc/foo.h")
+
+
+@pytest.mark.parametrize("content_cache", [None, ContentCache()])
+def test_binary_mode_keeps_carriage_returns(tmp_path, content_cache):
+    (tmp_path / "vendor.h").write_bytes(b"x\ry\n#define X \r\nX z\r\n")
+    (tmp_path / "main.c").write_bytes(b'#include "vendor.h"\na\rb\n')
+    handler = HeaderHandler([], content_cache=content_cache, binary=True)
+    output = io.BytesIO()
+    with open(str(tmp_path / "main.c"), "rb") as f_obj:
+        preprocess_to_file(f_obj, output, binary=True,
+                           include_paths=[tmp_path.as_posix()],
+                           header_handler=handler)
+    assert output.getvalue() == b"x\ry\n z\na\rb\n"
+
+
+def test_indexed_handler_misses_need_no_stat(tmp_path):
+    include = make_tree(tmp_path)
+    include_paths = [posixpath.join(include, "missing%d" % i)
+                     for i in range(10)]
+    handler = IndexedHeaderHandler(include_paths + [include])
+    f_obj = FakeFile("main.c", ["#include <top.h>\n", "#include <top.h>\n"])
+    with mock.patch("os.stat", wraps=os.stat) as stat:
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "types\ntypes\n"
+    assert sorted(set(call.args[0] for call in stat.call_args_list)) == [
+        posixpath.join(include, "sys", "types.h"),
+        posixpath.join(include, "top.h"),
+    ]
+
+
+def test_skip_file_checked_after_open():
+    handler = CountingHandler({"a.h": ["a\n"]}, include_paths=["x", "."])
+    skip = mock.Mock(return_value=True)
+    assert handler.open_header("a.h", skip, None) is SKIP_FILE
+    skip.assert_called_once_with("a.h")
+    assert handler.opened == ["x/a.h", "a.h"]
+
+
+def test_binary_mode_handler_mismatch():
+    with pytest.raises(ValueError):
+        Preprocessor(header_handler=FakeHandler({}), binary=True)
+    with pytest.raises(ValueError):
+        Preprocessor(header_handler=HeaderHandler([], binary=True))
+
+
+def test_add_include_paths_keeps_index(tmp_path):
+    include = make_tree(tmp_path)
+    index = DirectoryIndex()
+    assert index.exists(posixpath.join(include, "top.h"))
+    index_path = str(tmp_path / "index.json")
+    index.save(index_path)
+    handler = IndexedHeaderHandler([], index=DirectoryIndex.load(index_path))
+    assert handler.open_header("top.h", lambda _: False, None) is None
+    with mock.patch("os.scandir") as mock_scandir:
+        Preprocessor(include_paths=[include], header_handler=handler)
+        with handler.open_header("top.h", lambda _: False, None) as f_obj:
+            assert f_obj.read() == '#include <sys/types.h>\n'
+    assert not mock_scandir.called
+
+
+def test_memory_handler_decodes_once():
+    handler = MemoryHandler({"gen/a.h": memoryview(b"a\r\nb")})
+    f_obj = handler._open("gen/a.h")
+    assert f_obj is handler._open("gen/a.h")
+    assert list(f_obj) == ["a\r\n", "b"]
+    with mock.patch("io.StringIO") as string_io:
+        assert list(f_obj) == ["a\r\n", "b"]
+    assert not string_io.called
+    f_obj = handler._open("gen/x/../a.h")
+    assert (f_obj.name, f_obj.text) == ("gen/x/../a.h", "a\r\nb")
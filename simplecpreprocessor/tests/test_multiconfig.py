@@ -0,0 +1,239 @@
+from __future__ import absolute_import
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.core import constants_to_token_constants
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.multiconfig import (
+    MultiConfigPreprocessor, iter_configurations,
+    preprocess_configurations,
+)
+
+CONFIGURATIONS = [
+    {},
+    {"DEBUG": "1"},
+    {"ARCH": "2"},
+    {"DEBUG": "1", "ARCH": "2"},
+]
+
+
+def make_file(lines):
+    return FakeFile("header.h", lines)
+
+
+def check_against_single_runs(lines, configurations=CONFIGURATIONS,
+                              handler_mapping=None):
+    outputs = preprocess_configurations(
+        make_file(lines), configurations,
+        header_handler=FakeHandler(dict(handler_mapping or {}))
+    )
+    for configuration, output in zip(configurations, outputs):
+        expected = "".join(preprocess(
+            make_file(lines), extra_constants=configuration,
+            header_handler=FakeHandler(dict(handler_mapping or {}))
+        ))
+        assert output == expected, configuration
+    return outputs
+
+
+def test_iter_configurations():
+    assert list(iter_configurations(0b1011)) == [0, 1, 3]
+
+
+def test_ifdef_ifndef_else():
+    outputs = check_against_single_runs([
+        "#ifdef DEBUG\n",
+        "debug\n",
+        "#else\n",
+        "release\n",
+        "#endif\n",
+        "#ifndef ARCH\n",
+        "generic\n",
+        "#endif\n",
+    ])
+    assert outputs == [
+        "release\ngeneric\n",
+        "debug\ngeneric\n",
+        "release\n",
+        "debug\n",
+    ]
+
+
+def test_if_elif_chain():
+    outputs = check_against_single_runs([
+        "#if defined(DEBUG) && defined(ARCH)\n",
+        "both\n",
+        "#elif defined DEBUG\n",
+        "debug\n",
+        "#elif 1\n",
+        "other\n",
+        "#endif\n",
+    ])
+    assert outputs == ["other\n", "debug\n", "other\n", "both\n"]
+
+
+def test_nested_conditions():
+    check_against_single_runs([
+        "#ifdef DEBUG\n",
+        "#ifdef ARCH\n",
+        "inner\n",
+        "#else\n",
+        "noarch\n",
+        "#endif\n",
+        "#endif\n",
+        "end\n",
+    ])
+
+
+def test_defines_diverge_per_configuration():
+    outputs = check_against_single_runs([
+        "#ifdef DEBUG\n",
+        "#define LEVEL 3\n",
+        "#else\n",
+        "#define LEVEL 0\n",
+        "#endif\n",
+        "#undef ARCH\n",
+        "int level = LEVEL;\n",
+        "#ifdef ARCH\n",
+        "arch\n",
+        "#endif\n",
+        "#define F(x) (x + LEVEL)\n",
+        "F(1)\n",
+    ])
+    assert outputs[0] == "int level = 0;\n(1 + 0)\n"
+    assert outputs[1] == "int level = 3;\n(1 + 3)\n"
+
+
+def test_fold_strings_to_null():
+    outputs = preprocess_configurations(
+        make_file(['#define S "a"\n', 'S "b"\n']), [{}, {}],
+        fold_strings_to_null=True
+    )
+    assert outputs == ["NULL NULL\n", "NULL NULL\n"]
+
+
+def test_annotated_stream_shares_common_text():
+    configurations = [
+        constants_to_token_constants(c) for c in CONFIGURATIONS
+    ]
+    preprocessor = MultiConfigPreprocessor(configurations)
+    pairs = list(preprocessor.preprocess(make_file([
+        "common\n",
+        "#ifdef DEBUG\n",
+        "debug\n",
+        "#endif\n",
+    ])))
+    assert pairs == [(0b1111, "common\n"), (0b1010, "debug\n")]
+
+
+def test_include_with_guard_and_pragma_once():
+    mapping = {
+        "guarded.h": [
+            "#ifndef GUARDED\n",
+            "#define GUARDED\n",
+            "guarded\n",
+            "#endif\n",
+        ],
+        "once.h": [
+            "#pragma once\n",
+            "once\n",
+        ],
+        "debug.h": [
+            "debug_only\n",
+        ],
+    }
+    outputs = check_against_single_runs([
+        '#include "guarded.h"\n',
+        '#include "guarded.h"\n',
+        '#include "once.h"\n',
+        '#include "once.h"\n',
+        "#ifdef DEBUG\n",
+        '#include "debug.h"\n',
+        "#endif\n",
+    ], handler_mapping=mapping)
+    assert outputs[0] == "guarded\nonce\n"
+    assert outputs[1] == "guarded\nonce\ndebug_only\n"
+
+
+def test_ifdef_file_guard_per_configuration():
+    mapping = {"feature.h": ["#ifdef DEBUG\n", "feature\n", "#endif\n"]}
+    check_against_single_runs([
+        '#include "feature.h"\n',
+        '#include "feature.h"\n',
+    ], handler_mapping=mapping)
+
+
+def test_missing_include():
+    with pytest.raises(ParseError):
+        preprocess_configurations(
+            make_file(["#include <missing.h>\n"]), CONFIGURATIONS,
+            header_handler=FakeHandler({})
+        )
+
+
+def test_ignored_header():
+    outputs = preprocess_configurations(
+        make_file(["#include <other.h>\n", "x\n"]), CONFIGURATIONS,
+        header_handler=FakeHandler({"other.h": ["1\n"]}),
+        ignore_headers=["other.h"]
+    )
+    assert outputs == ["x\n"] * 4
+
+
+def test_pragma_pack():
+    outputs = preprocess_configurations(
+        make_file(["#ifdef DEBUG\n", "#pragma pack(1)\n", "#endif\n"]),
+        CONFIGURATIONS
+    )
+    assert outputs == ["", "#pragma pack(1)\n", "", "#pragma pack(1)\n"]
+
+
+def test_evaluation_error():
+    with pytest.raises(ParseError) as excinfo:
+        preprocess_configurations(
+            make_file(["#if 1 / 0\n", "#endif\n"]), CONFIGURATIONS
+        )
+    assert "Error evaluating #if on line 0" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("lines,message", [
+    (["#elif 1\n"], "Unexpected #elif"),
+    (["#else\n"], "Unexpected #else"),
+    (["#if 1\n", "#else\n", "#elif 1\n", "#endif\n"], "#elif after #else"),
+    (["#if 1\n", "#else\n", "#else\n", "#endif\n"], "#else after #else"),
+    (["#ifdef X\n"], "left open"),
+])
+def test_conditional_errors(lines, message):
+    with pytest.raises(ParseError) as excinfo:
+        preprocess_configurations(make_file(lines), CONFIGURATIONS)
+    assert message in str(excinfo.value)
+
+
+def test_directives_in_inactive_blocks():
+    outputs = check_against_single_runs([
+        "#define A 1\n",
+        "#ifdef NOWHERE\n",
+        "#define A 2\n",
+        "#undef A\n",
+        "#pragma pack(1)\n",
+        "#endif\n",
+        "A\n",
+    ])
+    assert outputs == ["1\n"] * 4
+
+
+def test_include_skipped_by_guard_after_different_spelling():
+    mapping = {
+        "guarded.h": [
+            "#ifndef GUARDED\n",
+            "#define GUARDED\n",
+            "guarded\n",
+            "#endif\n",
+        ],
+    }
+    handler = FakeHandler(mapping, include_paths=["."])
+    outputs = preprocess_configurations(
+        make_file(['#include "guarded.h"\n', '#include <./guarded.h>\n']),
+        CONFIGURATIONS, header_handler=handler
+    )
+    assert outputs == ["guarded\n"] * 4
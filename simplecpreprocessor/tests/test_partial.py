@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+import pytest
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.filesystem import FakeFile
+from simplecpreprocessor.partial import preprocess_partial
+
+
+def run_case(lines, expected, defines=(), undefines=()):
+    f_obj = FakeFile("header.h", lines)
+    ret = preprocess_partial(f_obj, defines=defines, undefines=undefines)
+    assert "".join(ret) == expected
+
+
+def test_known_ifdef_resolved():
+    run_case([
+        "#ifdef KNOWN\n",
+        "a\n",
+        "#else\n",
+        "b\n",
+        "#endif\n",
+    ], "a\n", defines={"KNOWN": "1"})
+
+
+def test_known_ifndef_resolved():
+    run_case([
+        "#ifndef GONE\n",
+        "a\n",
+        "#endif\n",
+        "#ifndef KNOWN\n",
+        "b\n",
+        "#else\n",
+        "c\n",
+        "#endif\n",
+    ], "a\nc\n", defines={"KNOWN": "1"}, undefines=["GONE"])
+
+
+def test_unknown_conditionals_kept_verbatim():
+    lines = [
+        "#ifdef OTHER\n",
+        "#define X 1\n",
+        "#undef Y\n",
+        "#include <foo.h>\n",
+        "#pragma once\n",
+        "X Y\n",
+        "#else\n",
+        "#ifndef OTHER2\n",
+        "z\n",
+        "#endif\n",
+        "#endif\n",
+    ]
+    run_case(lines, "".join(lines))
+
+
+def test_if_expression_on_known_macros():
+    run_case([
+        "#if defined(A) && !defined(B)\n",
+        "yes\n",
+        "#endif\n",
+        "#if defined(A) && defined(B)\n",
+        "no\n",
+        "#endif\n",
+    ], "yes\n", defines={"A": "1"}, undefines=["B"])
+
+
+def test_if_short_circuit_ignores_unknown_operand():
+    run_case([
+        "#if defined(A) || defined(UNKNOWN)\n",
+        "yes\n",
+        "#endif\n",
+    ], "yes\n", defines={"A": "1"})
+
+
+def test_if_unknown_operand_kept():
+    run_case([
+        "#if defined(A) && defined(UNKNOWN)\n",
+        "maybe\n",
+        "#endif\n",
+    ], "#if defined(A) && defined(UNKNOWN)\nmaybe\n#endif\n",
+        defines={"A": "1"})
+
+
+def test_if_value_of_defined_macro_is_unknown():
+    lines = [
+        "#if VERSION >= 2\n",
+        "new\n",
+        "#endif\n",
+    ]
+    run_case(lines, "".join(lines), defines={"VERSION": "3"})
+
+
+def test_if_value_of_undefined_macro_is_zero():
+    run_case([
+        "#if GONE + 1\n",
+        "yes\n",
+        "#endif\n",
+    ], "yes\n", undefines=["GONE"])
+
+
+def test_elif_chain_rewrites():
+    run_case([
+        "#if defined(A)\n",
+        "a\n",
+        "#elif defined(U)\n",
+        "u\n",
+        "#elif defined(B)\n",
+        "b\n",
+        "#elif defined(V)\n",
+        "v\n",
+        "#else\n",
+        "other\n",
+        "#endif\n",
+    ], "#if defined(U)\nu\n#else\nb\n#endif\n",
+        undefines=["A"], defines={"B": "1"})
+
+
+def test_elif_after_known_true_dropped():
+    run_case([
+        "#if defined(A)\n",
+        "a\n",
+        "#elif defined(U)\n",
+        "u\n",
+        "#else\n",
+        "other\n",
+        "#endif\n",
+    ], "a\n", defines={"A": "1"})
+
+
+def test_unknown_if_with_known_false_elif_and_else():
+    run_case([
+        "#ifdef U\n",
+        "u\n",
+        "#elif defined(A)\n",
+        "a\n",
+        "#else\n",
+        "other\n",
+        "#endif\n",
+    ], "#ifdef U\nu\n#else\nother\n#endif\n", undefines=["A"])
+
+
+def test_all_known_false_else_kept_without_directives():
+    run_case([
+        "#if 0\n",
+        "a\n",
+        "#elif defined(A)\n",
+        "b\n",
+        "#else\n",
+        "c\n",
+        "#endif\n",
+    ], "c\n", undefines=["A"])
+
+
+def test_removed_branch_drops_nested_groups():
+    run_case([
+        "#ifdef A\n",
+        "#ifdef U\n",
+        "#define X\n",
+        "#elif 1\n",
+        "#else\n",
+        "#endif\n",
+        "#if 1\n",
+        "#endif\n",
+        "#endif\n",
+        "kept\n",
+    ], "kept\n", undefines=["A"])
+
+
+def test_macros_are_not_expanded():
+    run_case([
+        "#define A 2\n",
+        "A\n",
+    ], "#define A 2\nA\n", defines={"A": "1"})
+
+
+def test_invalid_expression():
+    with pytest.raises(ParseError) as excinfo:
+        run_case(["#if 1 /\n", "#endif\n"], "")
+    assert "Error evaluating #if on line 0" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("lines,message", [
+    (["#elif 1\n"], "Unexpected #elif"),
+    (["#else\n"], "Unexpected #else"),
+    (["#endif\n"], "Unexpected #endif"),
+    (["#if U\n", "#else\n", "#elif 1\n", "#endif\n"], "#elif after #else"),
+    (["#if U\n", "#else\n", "#else\n", "#endif\n"], "#else after #else"),
+    (["#ifdef U\n"], "left open"),
+])
+def test_conditional_errors(lines, message):
+    with pytest.raises(ParseError) as excinfo:
+        run_case(lines, "")
+    assert message in str(excinfo.value)
+
+
+def test_known_true_elif_after_known_false():
+    run_case([
+        "#if 0\n",
+        "a\n",
+        "#elif 1\n",
+        "b\n",
+        "#endif\n",
+    ], "b\n")
+
+
+def test_unsupported_directive_kept():
+    lines = [
+        "#ifdef U\n",
+        "#error unsupported\n",
+        "#endif\n",
+        "#ifdef A\n",
+        "#error dropped\n",
+        "#endif\n",
+    ]
+    run_case(lines, "".join(lines[:3]), undefines=["A"])
+
+
+def test_define_of_known_undefined_macro():
+    run_case([
+        "#define A 1\n",
+        "#ifdef A\n",
+        "x\n",
+        "#else\n",
+        "y\n",
+        "#endif\n",
+    ], "#define A 1\nx\n", undefines=["A"])
+
+
+def test_undef_of_known_defined_macro():
+    run_case([
+        "#undef B\n",
+        "#ifdef B\n",
+        "y\n",
+        "#else\n",
+        "x\n",
+        "#endif\n",
+        "#define B 2\n",
+        "#if defined(B)\n",
+        "z\n",
+        "#endif\n",
+    ], "#undef B\nx\n#define B 2\nz\n", defines={"B": "1"})
+
+
+def test_define_in_kept_conditional_makes_macro_unknown():
+    lines = [
+        "#ifdef OTHER\n",
+        "#undef B\n",
+        "#define C 1\n",
+        "#endif\n",
+        "#ifdef B\n",
+        "b\n",
+        "#endif\n",
+        "#ifndef C\n",
+        "c\n",
+        "#endif\n",
+    ]
+    run_case(lines, "".join(lines), defines={"B": "1"}, undefines=["C"])
+
+
+def test_define_of_unknown_macro_stays_unknown():
+    lines = [
+        "#define OTHER 1\n",
+        "#ifdef OTHER\n",
+        "a\n",
+        "#endif\n",
+    ]
+    run_case(lines, "".join(lines))
@@ -1,13 +1,17 @@
 from __future__ import absolute_import
+import io
 import platform
 import os
 import mock
 import pytest
-from simplecpreprocessor import preprocess
+from simplecpreprocessor import (preprocess, preprocess_to_file,
+                                 preprocess_to_string)
 from simplecpreprocessor.platform import (calculate_platform_constants,
                                           extract_platform_spec)
 from simplecpreprocessor.filesystem import FakeFile, FakeHandler
 from simplecpreprocessor.exceptions import UnsupportedPlatform
+from simplecpreprocessor.sourcemap import SourceMap
+from simplecpreprocessor.tokens import TokenBatch, TokenType
 extract_platform_spec_path = ("simplecpreprocessor.platform."
                               "extract_platform_spec"
                               )
@@ -101,3 +105,99 @@ def test_platform():
     system = platform.system()
     bitness, _ = platform.architecture()
     assert extract_platform_spec() == (system, bitness)
+
+
+def test_preprocess_to_string():
+    f_obj = FakeFile("header.h", ["#define X 1\n", "X + X\n"])
+    assert preprocess_to_string(f_obj, line_ending="\r\n") == "1 + 1\r\n"
+
+
+def test_preprocess_to_file():
+    f_obj = FakeFile("header.h", ["#define X 1\n", "X + X\n"] + ["Y\n"] * 4)
+    output = io.StringIO()
+    with mock.patch.object(output, "writelines",
+                           wraps=output.writelines) as writelines:
+        with mock.patch("simplecpreprocessor.core.WRITE_BATCH", 4):
+            preprocess_to_file(f_obj, output)
+    assert output.getvalue() == "1 + 1\n" + "Y\n" * 4
+    assert [call[0][0] for call in writelines.call_args_list] == [
+        ["1 + 1\n", "Y\n", "Y\n", "Y\n"], ["Y\n"]
+    ]
+
+
+def test_eager_output_rejects_token_output():
+    f_obj = FakeFile("header.h", ["X\n"])
+    with pytest.raises(ValueError):
+        preprocess_to_string(f_obj, token_output=True)
+    with pytest.raises(ValueError):
+        preprocess_to_file(f_obj, io.StringIO(), token_output=True)
+
+
+def test_line_output():
+    f_obj = FakeFile("header.h", ["#define X 1\n",
+                                  "int a = X;\n",
+                                  "\n",
+                                  "#if 0\n", "skipped\n", "#endif\n",
+                                  "#pragma pack(1)\n",
+                                  "int b \\\n", "= X;\n",
+                                  'char *s = "x";\n'])
+    ret = list(preprocess(f_obj, line_output=True))
+    assert ret == ["int a = 1;\n", "\n", "#pragma pack(1)\n",
+                   "int b \\\n= 1;\n", 'char *s = "x";\n']
+    ret = list(preprocess(f_obj, line_output=True,
+                          fold_strings_to_null=True))
+    assert ret[-1] == "char *s = NULL;\n"
+
+
+def test_token_output():
+    handler = FakeHandler({"a.h": ["#define X 1\n", "int a = X;\n"]})
+    f_obj = FakeFile("main.c", ['#include "a.h"\n',
+                                "#pragma pack(1)\n",
+                                'char *s = "x";\n'])
+    ret = list(preprocess(f_obj, header_handler=handler,
+                          token_output=True, fold_strings_to_null=True))
+    assert all(isinstance(batch, TokenBatch) for batch in ret)
+    assert [(batch.source, batch.line_no) for batch in ret] == [
+        ("a.h", 1), ("main.c", 1), ("main.c", 2)
+    ]
+    assert [
+        "".join(token.value for token in batch) for batch in ret
+    ] == ["int a = 1;\n", "#pragma pack(1)\n", 'char *s = "x";\n']
+    assert [token.type for token in ret[2].tokens][-3:] == [
+        TokenType.STRING, TokenType.SYMBOL, TokenType.NEWLINE
+    ]
+    assert ret[1].tokens[0].type is TokenType.SYMBOL
+
+
+def test_compact_output():
+    f_obj = FakeFile("header.h", ["\n",
+                                  "   int  a ;  \n",
+                                  "\n",
+                                  "// comment\n",
+                                  "#ifdef X\n", "skipped\n", "#endif\n",
+                                  "\n",
+                                  "a/**/b  c\t+\t+d\n",
+                                  "f( x ,y ) \\\n",
+                                  "  ;\n",
+                                  "\n",
+                                  "\n"])
+    ret = preprocess(f_obj, compact=True)
+    assert "".join(ret) == "int a ;\n\nab c + +d\nf( x ,y ) \\\n;\n\n"
+    ret = list(preprocess(f_obj, compact=True, line_output=True))
+    assert ret == ["int a ;\n", "\n", "ab c + +d\n",
+                   "f( x ,y ) \\\n;\n", "\n"]
+
+
+def test_compact_output_source_map():
+    f_obj = FakeFile("header.h", ["\n", "\n", "a\n", "\n", "\n", "b\n"])
+    source_map = SourceMap()
+    ret = preprocess(f_obj, compact=True, source_map=source_map)
+    assert "".join(ret) == "a\n\nb\n"
+    assert list(source_map.lines) == [3, 4, 6]
+
+
+def test_preprocess_to_file_binary():
+    f_obj = FakeFile("header.h", [b"#define X \xff\n", "X\n"])
+    output = io.BytesIO()
+    preprocess_to_file(f_obj, output, binary=True)
+    assert output.getvalue() == b"\xff\n"
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.sourcemap import SourceMap
+
+
+def run_mapped(**kwargs):
+    handler = FakeHandler({"a.h": ["#pragma once\n",
+                                   "#define X 1\n",
+                                   "int a = X;\n"]})
+    f_obj = FakeFile("main.c", ['#include "a.h"\n',
+                                "#if 0\n", "skipped\n", "#endif\n",
+                                "#pragma pack(1)\n",
+                                "int b \\\n", "= X;\n"])
+    source_map = SourceMap()
+    output = list(preprocess(f_obj, header_handler=handler,
+                             source_map=source_map, **kwargs))
+    return output, source_map
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"line_output": True}])
+def test_source_map(kwargs):
+    output, source_map = run_mapped(**kwargs)
+    output = "".join(output)
+    assert output == "int a = 1;\n#pragma pack(1)\nint b \\\n= 1;\n"
+    assert len(source_map) == output.count("\n")
+    assert source_map.files == ["a.h", "main.c"]
+    assert [source_map.lookup(i) for i in range(1, 5)] == [
+        ("a.h", 3), ("main.c", 5), ("main.c", 6), ("main.c", 7)
+    ]
+
+
+def test_source_map_token_output():
+    batches, source_map = run_mapped(token_output=True)
+    assert len(batches) == 3
+    assert len(source_map) == 4
+
+
+def test_source_map_save_and_load(tmp_path):
+    _, source_map = run_mapped()
+    path = str(tmp_path / "out.h.map")
+    source_map.save(path)
+    loaded = SourceMap.load(path)
+    assert loaded.files == source_map.files
+    assert loaded.file_ids == source_map.file_ids
+    assert loaded.file_column == source_map.file_column
+    assert loaded.lines == source_map.lines
+    (tmp_path / "bad.map").write_bytes(b"not a map")
+    with pytest.raises(ValueError):
+        SourceMap.load(str(tmp_path / "bad.map"))
@@ -15,6 +15,8 @@ class TokenType(enum.Enum):
     NEWLINE = enum.auto()
     WHITESPACE = enum.auto()
     SYMBOL = enum.auto()
+    # Whole source line passed through without tokenizing
+    VERBATIM = enum.auto()
 
 
 class Token:
@@ -42,6 +44,22 @@ class Token:
         )  # pragma: no cover
 
 
+class TokenBatch:
+    """
+    Expanded tokens of one output line, with the name of the file and the
+    line number the line came from.
+    """
+    __slots__ = ["source", "line_no", "tokens"]
+
+    def __init__(self, source, line_no, tokens):
+        self.source = source
+        self.line_no = line_no
+        self.tokens = tokens
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+
 def is_string(value: Token):
     """
     Return True if the given token value is a C/C++ string literal.
@@ -189,18 +207,31 @@ class TokenExpander:
         return result
 
 
+def is_verbatim_line(line):
+    """
+    Return True if line can be output as is when it has no defined
+    macros: it has no directive, comment or line continuation.
+    """
+    return (
+        line.endswith("\n")
+        and "#" not in line
+        and "//" not in line
+        and "/*" not in line
+        and not line.endswith(("\\\n", "\\\r\n"))
+    )
+
+
 class Tokenizer:
     NO_COMMENT = Token.from_constant(None, None, TokenType.WHITESPACE)
 
-    def __init__(self, f_obj, line_ending):
+    def __init__(self, f_obj, line_ending, verbatim=False):
         self.source = enumerate(f_obj)
         self.line_ending = line_ending
+        # Emit qualifying lines as single VERBATIM tokens
+        self.verbatim = verbatim
         self.line_no = None
         self._scanner = re.Scanner([
-            (
-                r"\r\n|\n",
-                self._make_cb(TokenType.NEWLINE, normalize_newline=True)
-            ),
+            (r"\r\n|\n", self._newline_cb),
             (r"/\*", self._make_cb(TokenType.COMMENT_START)),
             (r"//", self._make_cb(TokenType.COMMENT_START)),
             (r"\*/", self._make_cb(TokenType.COMMENT_END)),
@@ -214,12 +245,15 @@ class Tokenizer:
             (r"\W", self._make_cb(TokenType.SYMBOL)),
         ])
 
-    def _make_cb(self, type_, normalize_newline=False):
+    def _make_cb(self, type_):
         def _cb(s, t):
-            val = self.line_ending if normalize_newline else t
-            return Token.from_string(self.line_no, val, type_)
+            return Token.from_string(self.line_no, t, type_)
         return _cb
 
+    def _newline_cb(self, s, t):
+        # Line endings are normalized, so there is no need to check t
+        return Token(self.line_no, self.line_ending, TokenType.NEWLINE, True)
+
     def _scan_line(self, line_no, line):
         self.line_no = line_no
         tokens, remainder = self._scanner.scan(line)
@@ -236,6 +270,22 @@ class Tokenizer:
         line_no = 0
 
         for line_no, line in self.source:
+            if (
+                self.verbatim
+                and comment is self.NO_COMMENT
+                and (token is None or token.chunk_mark)
+                and is_verbatim_line(line)
+            ):
+                if line.endswith("\r\n"):
+                    line = line[:-2]
+                else:
+                    line = line[:-1]
+                token = Token.from_string(
+                    line_no, line + self.line_ending, TokenType.VERBATIM
+                )
+                token.chunk_mark = True
+                yield token
+                continue
             tokens = self._scan_line(line_no, line)
             try:
                 token = next(tokens)
@@ -286,6 +336,14 @@ class Tokenizer:
             token.chunk_mark = True
             yield token
 
+    def rescan(self, line_no, line):
+        """Tokenize the text of a VERBATIM token into its chunk."""
+        # Swap the output line ending for one the scanner takes as a
+        # newline, "\r\n" so that a stray "\r" before it stays a symbol
+        line = line[:len(line) - len(self.line_ending)] + "\r\n"
+        self.source = iter([(line_no, line)])
+        return next(self.read_chunks())
+
     def read_chunks(self):
         chunk = []
         for token in self: